@@ -1,7 +1,8 @@
 from collections import defaultdict
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
+import cv2
+import matplotlib
+from PIL import Image
 from collections import deque
 
 
@@ -10,19 +11,34 @@ class UnionFind:
     
     素集合データセット
     https://note.nkmk.me/python-union-find/
+
+    Note:
+        親の配列を np.ndarray で持ち，find は再帰せずに経路圧縮する．
+        union_many / labels で多数のノードをまとめて処理できる．
     
     """
     def __init__(self, n):
         """ n (int): ノード数 """
         self.n = n
-        self.parents = [-1] * n
+        self._parent = np.arange(n, dtype=np.int64)    # 根は自分自身を指す
+        self._size = np.ones(n, dtype=np.int64)        # 根のみ有効
+
+    @property
+    def parents(self):
+        """ 従来の表現（根は -(グループのサイズ)，それ以外は親のノード） """
+        ret = self._parent.copy()
+        is_root = ret == np.arange(self.n)
+        ret[is_root] = -self._size[is_root]
+        return ret.tolist()
 
     def find(self, x):
-        if self.parents[x] < 0:
-            return x
-        else:
-            self.parents[x] = self.find(self.parents[x])
-            return self.parents[x]
+        parent = self._parent
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return int(root)
 
     def union(self, x, y):
         """ ノードxとノードyを統合する """
@@ -32,62 +48,135 @@ class UnionFind:
         if x == y:
             return
 
-        if self.parents[x] > self.parents[y]:
+        if self._size[x] < self._size[y]:
             x, y = y, x
 
-        self.parents[x] += self.parents[y]
-        self.parents[y] = x
+        self._size[x] += self._size[y]
+        self._parent[y] = x
+
+    def _compress(self):
+        """ すべてのノードの親を根にする（ポインタジャンプ） """
+        parent = self._parent
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent): break
+            parent[:] = grand
+
+    def union_many(self, xs, ys):
+        """
+
+        ノード xs[k] とノード ys[k] をまとめて統合する
+
+        Note:
+            根どうしを小さい番号の根へつなぐ操作を，すべての組が同じ根になるまで繰り返す
+
+        """
+        xs = np.asarray(xs, dtype=np.int64).ravel()
+        ys = np.asarray(ys, dtype=np.int64).ravel()
+        assert xs.shape == ys.shape
+        parent = self._parent
+        while True:
+            self._compress()
+            rx, ry = parent[xs], parent[ys]
+            diff = rx != ry
+            if not np.any(diff): break
+            xs, ys, rx, ry = xs[diff], ys[diff], rx[diff], ry[diff]
+            np.minimum.at(parent, np.maximum(rx, ry), np.minimum(rx, ry))
+        self._size = np.bincount(parent, minlength=self.n)
+
+    def labels(self):
+        """ 各ノードの根を np.ndarray で返す """
+        self._compress()
+        return self._parent.copy()
 
     def size(self, x):
-        return -self.parents[self.find(x)]
+        return int(self._size[self.find(x)])
 
     def same(self, x, y):
         return self.find(x) == self.find(y)
 
     def members(self, x):
         root = self.find(x)
-        return [i for i in range(self.n) if self.find(i) == root]
+        return np.flatnonzero(self.labels() == root).tolist()
 
     def roots(self):
-        return [i for i, x in enumerate(self.parents) if x < 0]
+        return np.flatnonzero(self._parent == np.arange(self.n)).tolist()
 
     def group_count(self):
         """ グループ数を返す """
-        return len(self.roots())
+        return int(np.count_nonzero(self._parent == np.arange(self.n)))
 
     def all_group_members(self):
+        """ 根をキーとして各グループのノードを返す（グループの順序は最小のノードの昇順） """
+        labels = self.labels()
+        order = np.argsort(labels, kind='stable')
+        roots, first, counts = np.unique(labels, return_index=True, return_counts=True)
+        members = np.split(order, np.cumsum(counts)[:-1])
         group_members = defaultdict(list)
-        for member in range(self.n):
-            group_members[self.find(member)].append(member)
+        for k in np.argsort(first, kind='stable'):
+            group_members[int(roots[k])] = members[k].tolist()
         return group_members
 
     def __str__(self):
         return '\n'.join(f'{r}: {m}' for r, m in self.all_group_members().items())
 
 
-class FloodFill:
-    @staticmethod
-    def _gif_init():
-        fig = plt.figure(figsize=(4,4))
-        ax = plt.gca()
-        ax.axes.xaxis.set_visible(False)
-        ax.axes.yaxis.set_visible(False)
-        imgs = []
-        return fig, imgs
-    
-    @staticmethod
-    def _gif_add(imgs: list, arr: np.ndarray):
-        img = plt.imshow(arr.T, animated=True)
-        imgs.append([img])
+class _FrameRecorder:
+    """
 
-    @staticmethod
-    def _gif_save(fig, imgs: list, filename: str):
-        ani = animation.ArtistAnimation(fig, imgs)
-        ani.save(filename, writer="imagemagick")
+    塗りつぶしの途中経過を uint8 のフレームとして記録し，Pillow で GIF に保存する
+
+    Note:
+        塗りつぶしでは元の配列の値と rcolor しか現れないので，その範囲で 0-255 に正規化して保存する．
+
+    """
+    SIZE = 400      # GIF の長辺の目安 [px]
+    MAX_FRAMES = 100    # フレームを記録する間隔を自動で決めるときのフレーム数の目安
+
+    def __init__(self, arr: np.ndarray, rcolor: int, filename: str, interval: int, duration: int):
+        self.filename = filename
+        self.interval = interval
+        self.duration = duration
+        self.vmin = min(arr.min(), rcolor)
+        self.vmax = max(arr.max(), rcolor)
+        self.frames = list()
+        self.cnt = 0    # 前回のフレームから塗りつぶした画素数
+
+    def add(self, arr: np.ndarray, filled: int = 1):
+        """ filled 画素塗りつぶすごとに呼び出す．interval 画素ごとにフレームを記録する． """
+        self.cnt += filled
+        if self.interval is not None and self.cnt >= self.interval: self.snapshot(arr)
+
+    def snapshot(self, arr: np.ndarray):
+        scale = 255/(self.vmax-self.vmin) if self.vmax != self.vmin else 0
+        self.frames.append(((arr.T - self.vmin)*scale).astype(np.uint8))
+        self.cnt = 0
+
+    def save(self, arr: np.ndarray):
+        if self.cnt != 0 or not self.frames: self.snapshot(arr)
+        palette = (matplotlib.colormaps["viridis"](np.arange(256))[:, :3]*255).astype(np.uint8)
+        scale = max(1, self.SIZE // max(self.frames[0].shape))
+        images = list()
+        for frame in self.frames:
+            image = Image.fromarray(frame, mode="P")
+            image.putpalette(palette.tobytes())
+            images.append(image.resize((frame.shape[1]*scale, frame.shape[0]*scale), Image.NEAREST))
+        images[0].save(
+            self.filename,
+            save_all=True,
+            append_images=images[1:],
+            duration=self.duration,
+            loop=0,
+        )
+
+
+class FloodFill:
+    DXS = [1, 0, -1, 0, 1, -1, -1, 1]
+    DYS = [0, 1, 0, -1, 1, 1, -1, -1]
 
     @staticmethod
     def stack(arr: np.ndarray, begin_y: int, begin_x: int, rcolor: int,
-            direction: int, filename: str = None):
+            direction: int, filename: str = None, frame_interval: int = None, frame_duration: int = 200):
         """
 
         FloodFill のスタックによる実装（開始位置に隣接する同色のマスを rcolor に塗りつぶす）．
@@ -99,6 +188,9 @@ class FloodFill:
             rcolor (int): 塗りつぶす色 (replacement-color)
             direction (int): 接続されているとみなす方向 (4 or 8)
             filename (str): 途中経過のアニメーションの保存パス．未指定の場合はアニメーション画像は保存されない．
+            frame_interval (int): アニメーションのフレームを記録する間隔（塗りつぶした画素数）．
+                未指定なら塗りつぶしうる画素数からフレーム数が _FrameRecorder.MAX_FRAMES 程度になるように決める．
+            frame_duration (int): アニメーションの 1 フレームの表示時間 [ms]
 
         Notes:
             入力配列が大きすぎるとスタックオーバーフローが発生する可能性あり．
@@ -107,10 +199,8 @@ class FloodFill:
         def execute_fill(arr, begin_y, begin_x, tcolor, rcolor, direction):
             if not arr[begin_y, begin_x] == tcolor: return
             arr[begin_y, begin_x] = rcolor
-            if filename: FloodFill._gif_add(imgs=imgs, arr=arr)
-            dxs = [1, 0, -1, 0, 1, -1, -1, 1]
-            dys = [0, 1, 0, -1, 1, 1, -1, -1]
-            for dx, dy in zip(dxs[:direction], dys[:direction]):
+            if recorder: recorder.add(arr)
+            for dx, dy in zip(FloodFill.DXS[:direction], FloodFill.DYS[:direction]):
                 nx = begin_x + dx
                 ny = begin_y + dy
                 if 0 <= nx < arr.shape[1] and 0 <= ny < arr.shape[0]:
@@ -119,13 +209,15 @@ class FloodFill:
         assert direction in [4, 8], "direction must be 4 or 8."
         tcolor = arr[begin_y, begin_x]
         if tcolor == rcolor: return
-        if filename: fig, imgs = FloodFill._gif_init()
+        if filename and frame_interval is None:
+            frame_interval = max(1, int(np.count_nonzero(arr == tcolor)) // _FrameRecorder.MAX_FRAMES)
+        recorder = _FrameRecorder(arr, rcolor, filename, frame_interval, frame_duration) if filename else None
         execute_fill(arr, begin_y, begin_x, tcolor, rcolor, direction)
-        if filename: FloodFill._gif_save(fig=fig, imgs=imgs, filename=filename)
+        if recorder: recorder.save(arr)
 
     @staticmethod
     def queue(arr: np.ndarray, begin_y: int, begin_x: int, rcolor: int,
-              direction: int, filename: str = None):
+              direction: int, filename: str = None, frame_interval: int = None, frame_duration: int = 200):
         """
 
         FloodFill のキューによる実装（開始位置に隣接する同色のマスを rcolor に塗りつぶす）．
@@ -137,20 +229,22 @@ class FloodFill:
             rcolor (int): 塗りつぶす色 (replacement-color)
             direction (int): 接続されているとみなす方向 (4 or 8)
             filename (str): 途中経過のアニメーションの保存パス．未指定の場合はアニメーション画像は保存されない．
+            frame_interval (int): アニメーションのフレームを記録する間隔（塗りつぶした画素数）．未指定なら幅優先探索の階層ごとに記録する．
+            frame_duration (int): アニメーションの 1 フレームの表示時間 [ms]
 
         """
         assert direction in [4, 8], "direction must be 4 or 8."
         tcolor = arr[begin_y, begin_x]
         if tcolor == rcolor: return
-        if filename: fig, imgs = FloodFill._gif_init()
+        recorder = _FrameRecorder(arr, rcolor, filename, frame_interval, frame_duration) if filename else None
+        neighbors = list(zip(FloodFill.DXS[:direction], FloodFill.DYS[:direction]))
         q = deque()
         q.append((begin_y, begin_x))
         arr[begin_y, begin_x] = rcolor
+        level_remain, next_level = 1, 0     # 幅優先探索の現在の階層の残りと次の階層の画素数
         while q:
             y, x = q.popleft()
-            dxs = [1, 0, -1, 0, 1, -1, -1, 1]
-            dys = [0, 1, 0, -1, 1, 1, -1, -1]
-            for dx, dy in zip(dxs[:direction], dys[:direction]):
+            for dx, dy in neighbors:
                 nx = x + dx
                 ny = y + dy
                 if not 0 <= nx < arr.shape[1]: continue
@@ -158,8 +252,137 @@ class FloodFill:
                 if arr[ny, nx] != tcolor: continue
                 arr[ny, nx] = rcolor
                 q.append((ny, nx))
-                if filename: FloodFill._gif_add(imgs=imgs, arr=arr)
-        if filename: FloodFill._gif_save(fig=fig, imgs=imgs, filename=filename)
+                next_level += 1
+                if recorder: recorder.add(arr)
+            level_remain -= 1
+            if level_remain == 0:
+                if recorder and frame_interval is None and next_level != 0: recorder.snapshot(arr)
+                level_remain, next_level = next_level, 0
+        if recorder: recorder.save(arr)
+
+    @staticmethod
+    def scanline(arr: np.ndarray, begin_y: int, begin_x: int, rcolor: int, direction: int):
+        """
+
+        FloodFill のスキャンライン（行ごとの区間）による実装（開始位置に隣接する同色のマスを rcolor に塗りつぶす）．
+
+        Args:
+            arr (np.ndarray): 塗りつぶしを行う対象の二次元配列
+            begin_y (int): 塗りつぶし開始マスの行
+            begin_x (int): 塗りつぶし開始マスの列
+            rcolor (int): 塗りつぶす色 (replacement-color)
+            direction (int): 接続されているとみなす方向 (4 or 8)
+
+        Notes:
+            区間単位でスタックに積むので，画素単位の実装のようなスタックオーバーフローは起きない．
+
+        """
+        assert direction in [4, 8], "direction must be 4 or 8."
+        tcolor = arr[begin_y, begin_x]
+        if tcolor == rcolor: return
+        H, W = arr.shape
+        ext = 1 if direction == 8 else 0   # 8 方向なら斜め上下の区間も隣接
+
+        # 画素ごとの np.ndarray へのアクセスは遅いので，塗りつぶし対象のマスクを list で持つ
+        targets = (arr == tcolor).tolist()
+        spans = list()
+        stack = [(begin_y, begin_x)]
+        while stack:
+            y, x = stack.pop()
+            row = targets[y]
+            if not row[x]: continue
+
+            # 同色の区間 [l, r) を求める
+            l, r = x, x+1
+            while l > 0 and row[l-1]: l -= 1
+            while r < W and row[r]: r += 1
+            row[l:r] = [False]*(r-l)
+            spans.append((y, l, r))
+
+            # 上下の行で隣接する同色の区間の先頭を積む
+            lo, hi = max(l-ext, 0), min(r+ext, W)
+            for ny in (y-1, y+1):
+                if not 0 <= ny < H: continue
+                nrow = targets[ny]
+                prev = False
+                for nx in range(lo, hi):
+                    cur = nrow[nx]
+                    if cur and not prev: stack.append((ny, nx))
+                    prev = cur
+
+        for y, l, r in spans:
+            arr[y, l:r] = rcolor
+
+    @staticmethod
+    def label(arr: np.ndarray, begin_y: int, begin_x: int, rcolor: int, direction: int):
+        """
+
+        連結成分のラベリング (cv2.connectedComponents) による FloodFill の実装（開始位置に隣接する同色のマスを rcolor に塗りつぶす）．
+
+        Args:
+            arr (np.ndarray): 塗りつぶしを行う対象の二次元配列
+            begin_y (int): 塗りつぶし開始マスの行
+            begin_x (int): 塗りつぶし開始マスの列
+            rcolor (int): 塗りつぶす色 (replacement-color)
+            direction (int): 接続されているとみなす方向 (4 or 8)
+
+        """
+        assert direction in [4, 8], "direction must be 4 or 8."
+        tcolor = arr[begin_y, begin_x]
+        if tcolor == rcolor: return
+        mask = (arr == tcolor).view(np.uint8)
+        _, labels = cv2.connectedComponents(mask, connectivity=direction, ltype=cv2.CV_32S)
+        arr[labels == labels[begin_y, begin_x]] = rcolor
+
+    @staticmethod
+    def fill(arr: np.ndarray, begin_y: int, begin_x: int, rcolor: int,
+             direction: int, method: str = "scanline", filename: str = None, **kwargs):
+        """
+
+        method で指定した実装で FloodFill を行う（開始位置に隣接する同色のマスを rcolor に塗りつぶす）．
+
+        Args:
+            method (str): "queue", "stack", "scanline", "label" のいずれか
+            filename (str): 途中経過のアニメーションの保存パス ("queue", "stack" のみ対応)
+            kwargs: frame_interval, frame_duration ("queue", "stack" のみ対応)
+            その他は FloodFill.queue と同じ
+
+        """
+        if method in ("queue", "stack"):
+            getattr(FloodFill, method)(arr=arr, begin_y=begin_y, begin_x=begin_x,
+                                       rcolor=rcolor, direction=direction, filename=filename, **kwargs)
+        elif method in ("scanline", "label"):
+            assert filename is None and not kwargs, f"method '{method}' does not support animation."
+            getattr(FloodFill, method)(arr=arr, begin_y=begin_y, begin_x=begin_x,
+                                       rcolor=rcolor, direction=direction)
+        else:
+            assert False, f"unknown method: {method}"
+
+
+def benchmark_flood_fill(shape: tuple = (1000, 1000), methods: list = None, seed: int = 0):
+    """
+
+    FloodFill の各実装のスループット [Mpx/s]（塗りつぶした画素数 / 時間）を計測して表示する
+
+    """
+    import time
+    if methods is None: methods = ["queue", "scanline", "label"]
+    rng = np.random.default_rng(seed)
+    # 塗りつぶし領域が入り組むように，ランダムな図形を拡大して二値化した画像
+    noise = rng.random((shape[0]//20+2, shape[1]//20+2))
+    arr = (cv2.resize(noise, shape[::-1], interpolation=cv2.INTER_CUBIC) < 0.35).astype(np.uint8)
+    arr[0, 0] = 0
+    for direction in [4, 8]:
+        expected = None
+        for method in methods:
+            tmp = arr.copy()
+            begin = time.perf_counter()
+            FloodFill.fill(tmp, 0, 0, rcolor=2, direction=direction, method=method)
+            elapsed = time.perf_counter() - begin
+            filled = int(np.count_nonzero(tmp == 2))
+            if expected is None: expected = tmp
+            assert np.array_equal(expected, tmp)
+            print(f"{method:>8} (direction={direction}): {filled/elapsed/1e6:8.3f} Mpx/s  ({filled} px, {elapsed:.3f} s)")
 
 
 if __name__ == '__main__':
@@ -173,4 +396,5 @@ if __name__ == '__main__':
                     [1,0,0,0,1,0,0,0,0,0,1],
                     [1,0,1,1,1,1,1,1,1,1,1]])
 
+    benchmark_flood_fill()
     FloodFill.queue(arr, 8, 1, rcolor=2, direction=4, filename='flood_fill.gif')
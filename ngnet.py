@@ -1,7 +1,6 @@
 import matplotlib.pyplot as plt
 from matplotlib.patches import Ellipse
 import numpy as np
-import cv2
 import math
 
 
@@ -12,6 +11,9 @@ class NGnet:
             grid: list[np.ndarray, np.ndarray],
             basis_num: int,
             symmetry: bool=False,
+            dtype: type=np.float64,
+            max_bytes: int=None,
+            tol: float=None,
         ):
         """
         
@@ -19,6 +21,9 @@ class NGnet:
             grid (list[np.ndarray, np.ndarray]): 形状関数を計算する座標 (np.meshgrid)
             basis_num (int): 基底の数
             symmetry (bool): 回転対称の制約を課すか
+            dtype (type): ガウス関数の計算精度 (np.float64 or np.float32)
+            max_bytes (int): ガウス関数の計算に使う一時配列の上限 [byte]．超える場合は基底を分割して計算する．未指定なら一括で計算する．
+            tol (float): 各基底をピークの tol 倍になる範囲で打ち切って計算する (0 < tol < 1)．未指定なら格子全体で計算する．
 
         Note:
             grid は格子の頂点の座標ではなく形状関数を計算する座標値
@@ -27,38 +32,284 @@ class NGnet:
         self.grid_x, self.grid_y = grid
         self.basis_num = basis_num
         self.symmetry = symmetry
+        self.dtype = np.dtype(dtype)
+        self.max_bytes = max_bytes
+        self.tol = tol
+        self._basis_cache = None    # (基底パラメータのキー, 正規化した基底)
 
         assert type(self.grid_x) == type(self.grid_y) == np.ndarray
         assert len(self.grid_x.shape) == 2
         assert self.grid_x.shape == self.grid_y.shape
+        assert self.dtype in (np.float32, np.float64)
+        if self.tol is not None:
+            # 打ち切り範囲を二分探索で求めるので，軸に沿った昇順の格子に限る
+            assert 0 < self.tol < 1
+            assert np.all(self.grid_x == self.grid_x[0]) and np.all(np.diff(self.grid_x[0]) > 0)
+            assert np.all(self.grid_y == self.grid_y[:, :1]) and np.all(np.diff(self.grid_y[:, 0]) > 0)
 
-    def __gaussian_2d(self, pos: list[float, float], r: list[float, float], theta: float):
-        # X, Y は二次元配列
-        X, Y = self.grid_x, self.grid_y
-        input_shape = X.shape
-        mu_x, mu_y = pos
-        sx, sy = r
-
-        # 定数の計算
-        mu = np.array([[mu_x], [mu_y]])
-        diag = np.diag([sx**2, sy**2])
-        eigen_mat = np.array([
-            [np.cos(theta), -np.sin(theta)],
-            [np.sin(theta), np.cos(theta)],
-        ])
-        cov = eigen_mat@diag@(eigen_mat.T)
-        cov_inv = np.linalg.inv(cov)
-        coef = 1/(2*np.pi*np.sqrt(np.linalg.det(cov)))
-
-        # 入力に次元を合わせる
-        mu = np.full(input_shape+(2, 1), mu)
-        cov_inv = np.full(input_shape+(2, 2), cov_inv)
-
-        # ガウス関数を計算
-        pos = np.array([[X], [Y]]).transpose(2, 3, 0, 1) - mu
-        pos_t = pos.transpose(0, 1, 3, 2)
-        ret = coef * np.exp(-0.5*pos_t@cov_inv@pos)
-        return ret.reshape(input_shape)
+    def _gaussian_params(
+        self,
+        poss: list[list[float, float]],
+        rs: (list[list[float, float]]),
+        thetas: list[float],
+    ):
+        """
+
+        各基底のガウス関数を二次形式 a*dx^2 + 2*b*dx*dy + c*dy^2 で表したときの係数を計算する
+
+        Returns:
+            tuple[np.ndarray, ...]: (mux, muy, a, b, c, coef) それぞれ形状 (basis_num,)
+
+        Note:
+            Σ^{-1} = R diag(1/sx^2, 1/sy^2) R^T を展開した閉形式なので逆行列の計算は不要
+
+        """
+        poss = np.asarray(poss, dtype=np.float64).reshape(-1, 2)
+        rs = np.asarray(rs, dtype=np.float64).reshape(-1, 2)
+        thetas = np.asarray(thetas, dtype=np.float64).reshape(-1)
+        sx2, sy2 = rs[:, 0]**2, rs[:, 1]**2
+        cos, sin = np.cos(thetas), np.sin(thetas)
+        a = cos**2/sx2 + sin**2/sy2
+        b = cos*sin*(1/sx2 - 1/sy2)
+        c = sin**2/sx2 + cos**2/sy2
+        coef = 1/(2*np.pi*np.abs(rs[:, 0]*rs[:, 1]))
+        return tuple(p.astype(self.dtype) for p in (poss[:, 0], poss[:, 1], a, b, c, coef))
+
+    def _gaussian_stack(self, params: tuple, begin: int, end: int,
+                        X: np.ndarray = None, Y: np.ndarray = None):
+        """
+
+        基底 begin:end のガウス関数をまとめて計算して (end-begin, H, W) の配列で返す
+
+        Note:
+            X, Y を指定するとその座標で計算する（戻り値は (end-begin,)+X.shape）
+
+        """
+        if X is None: X, Y = self.grid_x, self.grid_y
+        mux, muy, a, b, c, coef = [p[begin:end].reshape((-1,)+(1,)*X.ndim) for p in params]
+        dx = X.astype(self.dtype) - mux
+        dy = Y.astype(self.dtype) - muy
+
+        # 一時配列を増やさないように in-place で二次形式を計算
+        ret = dx*dx
+        ret *= a
+        dx *= dy
+        dx *= 2*b
+        ret += dx
+        dy *= dy
+        dy *= c
+        ret += dy
+        ret *= -0.5
+        np.exp(ret, out=ret)
+        ret *= coef
+        return ret
+
+    def _chunk_size(self):
+        """ max_bytes に収まるように一度に計算する基底の数を決める """
+        if self.max_bytes is None: return self.basis_num
+        # _gaussian_stack は (基底数, H, W) の配列を 3 つ確保する
+        per_basis = 3*self.grid_x.size*np.dtype(self.dtype).itemsize
+        return int(min(self.basis_num, max(1, self.max_bytes // per_basis)))
+
+    def _support_boxes(
+        self,
+        poss: list[list[float, float]],
+        rs: (list[list[float, float]]),
+        thetas: list[float],
+    ):
+        """
+
+        各基底を打ち切って評価する範囲を格子のスライス (slice(i0, i1), slice(j0, j1)) で返す
+
+        Note:
+            値がピークの tol 倍となる楕円 (k = sqrt(-2 ln tol) シグマ) の外接矩形
+
+        """
+        poss = np.asarray(poss, dtype=np.float64).reshape(-1, 2)
+        rs = np.asarray(rs, dtype=np.float64).reshape(-1, 2)
+        thetas = np.asarray(thetas, dtype=np.float64).reshape(-1)
+        k = np.sqrt(-2*np.log(self.tol))
+        cos, sin = np.cos(thetas), np.sin(thetas)
+        hx = k*np.hypot(rs[:, 0]*cos, rs[:, 1]*sin)
+        hy = k*np.hypot(rs[:, 0]*sin, rs[:, 1]*cos)
+
+        xs, ys = self.grid_x[0], self.grid_y[:, 0]
+        i0 = np.searchsorted(ys, poss[:, 1]-hy, side='left')
+        i1 = np.searchsorted(ys, poss[:, 1]+hy, side='right')
+        j0 = np.searchsorted(xs, poss[:, 0]-hx, side='left')
+        j1 = np.searchsorted(xs, poss[:, 0]+hx, side='right')
+        return [(slice(a, b), slice(c, d)) for a, b, c, d in zip(i0, i1, j0, j1)]
+
+    def _truncated_shape_func(self, weights: np.ndarray, params: tuple, boxes: list):
+        """
+
+        各基底を打ち切った範囲だけで評価して形状関数を計算する
+
+        Note:
+            どの基底の範囲にも入らない（gauss_sum が 0 の）画素だけは打ち切らずに計算し直す
+
+        """
+        numer = np.zeros(self.grid_x.shape, dtype=self.dtype)
+        gauss_sum = np.zeros(self.grid_x.shape, dtype=self.dtype)
+        for n, (si, sj) in enumerate(boxes):
+            if si.start >= si.stop or sj.start >= sj.stop: continue
+            gauss = self._gaussian_stack(params, n, n+1, X=self.grid_x[si, sj], Y=self.grid_y[si, sj])[0]
+            gauss_sum[si, sj] += gauss
+            numer[si, sj] += weights[n]*gauss
+
+        rest = gauss_sum == 0
+        if np.any(rest):
+            X, Y = self.grid_x[rest], self.grid_y[rest]
+            chunk = self._chunk_size()
+            for begin in range(0, self.basis_num, chunk):
+                end = min(begin+chunk, self.basis_num)
+                gauss = self._gaussian_stack(params, begin, end, X=X, Y=Y)
+                gauss_sum[rest] += gauss.sum(axis=0)
+                numer[rest] += np.tensordot(weights[begin:end], gauss, axes=1)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return numer/gauss_sum
+
+    def get_shape_func(
+        self,
+        weights: list[float],
+        poss: list[list[float, float]],
+        rs: (list[list[float, float]]),
+        thetas: list[float],
+    ):
+        """
+
+        正規化ガウス関数の重み付き和（形状関数）を計算する
+
+        Args:
+            weights (list[float]): 基底関数の重み (w1, w2, ...)
+            poss (list[list[flota, float]]): 基底関数の中心 ((mux1, muy1), (mux2, muy2), ...)
+            rs (list[list[flota, float]]): 基底関数の標準偏差 ((sx1, sy1), (sx2, sy2), ...)
+            thetas (list[float]): 基底の楕円の角度 [rad] (theta1, theta2, ...)
+
+        Note:
+            sum(w*g/sum(g)) を sum(w*g)/sum(g) として計算するので，基底を分割して計算してもメモリは (H, W) 二枚で済む
+            tol を指定した場合は各基底を外接矩形の範囲だけで評価する
+
+        """
+        assert self.basis_num == len(weights) == len(poss) == len(rs) == len(thetas)
+
+        weights = np.asarray(weights, dtype=self.dtype)
+        params = self._gaussian_params(poss=poss, rs=rs, thetas=thetas)
+        if self.tol is not None:
+            boxes = self._support_boxes(poss=poss, rs=rs, thetas=thetas)
+            return self._truncated_shape_func(weights=weights, params=params, boxes=boxes)
+
+        numer = np.zeros(self.grid_x.shape, dtype=self.dtype)
+        gauss_sum = np.zeros(self.grid_x.shape, dtype=self.dtype)
+        chunk = self._chunk_size()
+        for begin in range(0, self.basis_num, chunk):
+            end = min(begin+chunk, self.basis_num)
+            gauss = self._gaussian_stack(params, begin, end)
+            gauss_sum += gauss.sum(axis=0)
+            numer += np.tensordot(weights[begin:end], gauss, axes=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return numer/gauss_sum
+
+    @staticmethod
+    def _basis_key(
+        poss: list[list[float, float]],
+        rs: (list[list[float, float]]),
+        thetas: list[float],
+    ):
+        """ 基底パラメータを正規化基底のキャッシュのキーに変換する """
+        return tuple(np.asarray(p, dtype=np.float64).tobytes() for p in (poss, rs, thetas))
+
+    def get_normalized_basis(
+        self,
+        poss: list[list[float, float]],
+        rs: (list[list[float, float]]),
+        thetas: list[float],
+    ):
+        """
+
+        正規化ガウス関数 g/sum(g) を (basis_num, H, W) の配列で返す
+
+        Note:
+            直前に計算した基底パラメータと一致する場合はキャッシュを返す（書き換えないこと）
+
+        """
+        assert self.basis_num == len(poss) == len(rs) == len(thetas)
+
+        key = self._basis_key(poss=poss, rs=rs, thetas=thetas)
+        if self._basis_cache is not None and self._basis_cache[0] == key:
+            return self._basis_cache[1]
+
+        params = self._gaussian_params(poss=poss, rs=rs, thetas=thetas)
+        normalized = np.empty((self.basis_num,)+self.grid_x.shape, dtype=self.dtype)
+        chunk = self._chunk_size()
+        for begin in range(0, self.basis_num, chunk):
+            end = min(begin+chunk, self.basis_num)
+            normalized[begin:end] = self._gaussian_stack(params, begin, end)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            normalized /= normalized.sum(axis=0)
+
+        self._basis_cache = (key, normalized)
+        return normalized
+
+    def _threshold(self, shape_func: np.ndarray, out: np.ndarray = None):
+        """
+
+        形状関数を二値化して分布 (uint8) を返す．symmetry が True なら 180 度回転したものを下に連結する．
+
+        Args:
+            shape_func (np.ndarray): (..., H, W) の形状関数
+            out (np.ndarray): 結果を書き込む uint8 配列 (..., H, W) または (..., 2H, W)．未指定なら新たに確保する．
+
+        """
+        H = shape_func.shape[-2]
+        out_shape = shape_func.shape[:-2] + ((2*H if self.symmetry else H),) + shape_func.shape[-1:]
+        if out is None: out = np.empty(out_shape, dtype=np.uint8)
+        assert out.dtype == np.uint8 and out.shape == out_shape
+
+        # uint8 を bool として見て比較結果を直接書き込む（0 or 1）
+        top = out[..., :H, :]
+        np.greater_equal(shape_func, 0, out=top.view(np.bool_))
+
+        if self.symmetry:
+            # cv2.ROTATE_180 と同じ
+            np.copyto(out[..., H:, :], top[..., ::-1, ::-1])
+
+        return out
+
+    def get_dists(
+        self,
+        weights: np.ndarray,
+        poss: list[list[float, float]],
+        rs: (list[list[float, float]]),
+        thetas: list[float],
+        out: np.ndarray = None,
+    ):
+        """
+
+        基底を固定して複数の重みに対する分布をまとめて計算する
+
+        Args:
+            weights (np.ndarray): 基底関数の重みを並べた (pop, basis_num) の配列（CMA-ES の一世代分など）
+            poss (list[list[flota, float]]): 基底関数の中心 ((mux1, muy1), (mux2, muy2), ...)
+            rs (list[list[flota, float]]): 基底関数の標準偏差 ((sx1, sy1), (sx2, sy2), ...)
+            thetas (list[float]): 基底の楕円の角度 [rad] (theta1, theta2, ...)
+            out (np.ndarray): 結果を書き込む uint8 配列．繰り返し呼び出すときに渡すと確保を省ける．
+
+        Returns:
+            np.ndarray: (pop, H, W) の分布．symmetry が True なら (pop, 2H, W)
+
+        Note:
+            正規化した基底は基底パラメータをキーとしてキャッシュされるので，
+            poss, rs, thetas が前回と同じなら重み付き和だけを計算する
+
+        """
+        weights = np.asarray(weights, dtype=self.dtype)
+        assert len(weights.shape) == 2 and weights.shape[1] == self.basis_num
+
+        normalized = self.get_normalized_basis(poss=poss, rs=rs, thetas=thetas)
+        shape_funcs = np.tensordot(weights, normalized, axes=1)
+        return self._threshold(shape_funcs, out=out)
 
     def get_dist(
         self,
@@ -66,6 +317,7 @@ class NGnet:
         poss: list[list[float, float]],
         rs: (list[list[float, float]]),
         thetas: list[float],
+        out: np.ndarray = None,
     ):
         """
 
@@ -74,26 +326,13 @@ class NGnet:
             poss (list[list[flota, float]]): 基底関数の中心 ((mux1, muy1), (mux2, muy2), ...)
             rs (list[list[flota, float]]): 基底関数の標準偏差 ((sx1, sy1), (sx2, sy2), ...)
             thetas (list[float]): 基底の楕円の角度 [rad] (theta1, theta2, ...)                    
+            out (np.ndarray): 結果を書き込む uint8 配列 (H, W)．symmetry が True なら (2H, W)．
                 
         """
         assert self.basis_num == len(weights) == len(poss) == len(rs) == len(thetas)
 
-        # TODO: 行列計算に対応させる
-        gauss = [self.__gaussian_2d(pos=pos, r=r, theta=theta) \
-                 for pos, r, theta in zip(poss, rs, thetas)]
-        gauss_sum = sum(gauss)
-        normalized = [g/gauss_sum for g in gauss]
-        shape_func = sum([w*b for w, b in zip(weights, normalized)])
-        dist = np.zeros(shape_func.shape, dtype=np.uint8)
-        for i in range(shape_func.shape[0]):
-            for j in range(shape_func.shape[1]):
-                dist[i][j] = (shape_func[i][j] >= 0)*1.0
-        
-        if self.symmetry:
-            tmp = cv2.rotate(dist, cv2.ROTATE_180)
-            dist = np.concatenate([dist, tmp])
-
-        return dist
+        shape_func = self.get_shape_func(weights=weights, poss=poss, rs=rs, thetas=thetas)
+        return self._threshold(shape_func, out=out)
     
     def plot_basis(
         self,
@@ -129,6 +368,123 @@ class NGnet:
         plt.cla(), plt.clf()
 
 
+class IncrementalNGnet(NGnet):
+    """
+
+    基底ごとのガウス関数と gauss_sum を保持し，前回から変化した基底の寄与だけを差し替えて形状関数を計算する NGnet
+
+    Note:
+        get_dist / get_shape_func の使い方は NGnet と同じ．
+        前回の poss, rs, thetas と比較して変化した基底だけを計算し直す．
+
+    """
+    def __init__(
+            self,
+            grid: list[np.ndarray, np.ndarray],
+            basis_num: int,
+            symmetry: bool=False,
+            dtype: type=np.float64,
+            max_bytes: int=None,
+            refresh_interval: int=100,
+        ):
+        """
+
+        Args:
+            refresh_interval (int): 差分更新をこの回数行ったら全基底を計算し直す（浮動小数点誤差の蓄積を抑える）
+            その他は NGnet と同じ
+
+        """
+        super().__init__(grid=grid, basis_num=basis_num, symmetry=symmetry, dtype=dtype, max_bytes=max_bytes)
+        assert refresh_interval >= 1
+        self.refresh_interval = refresh_interval
+        self.update_cnt = 0         # 前回の全計算からの差分更新の回数
+        self._params = None         # 基底パラメータ (poss, rs, thetas) の np.ndarray
+        self._gauss = None          # (basis_num, H, W) のガウス関数
+        self._gauss_sum = None      # (H, W)
+        self._weights = None        # _numer を計算したときの重み
+        self._numer = None          # (H, W) の重み付き和
+
+    def _recompute(self, params: tuple):
+        """ すべての基底を計算し直す """
+        gauss_params = self._gaussian_params(*params)
+        if self._gauss is None:
+            self._gauss = np.empty((self.basis_num,)+self.grid_x.shape, dtype=self.dtype)
+        chunk = self._chunk_size()
+        for begin in range(0, self.basis_num, chunk):
+            end = min(begin+chunk, self.basis_num)
+            self._gauss[begin:end] = self._gaussian_stack(gauss_params, begin, end)
+        self._gauss_sum = self._gauss.sum(axis=0)
+        self._weights = None
+        self._numer = None
+        self.update_cnt = 0
+
+    def _update(self, params: tuple, indices: np.ndarray):
+        """ indices の基底だけ計算し直して gauss_sum (と重み付き和) を差分更新する """
+        gauss_params = self._gaussian_params(*[p[indices] for p in params])
+        old = self._gauss[indices]
+        new = self._gaussian_stack(gauss_params, 0, len(indices))
+        removed = old.sum(axis=0)
+        self._gauss_sum -= removed
+        self._gauss_sum += new.sum(axis=0)
+        if self._numer is not None:
+            self._numer += np.tensordot(self._weights[indices], new-old, axes=1)
+        self._gauss[indices] = new
+
+        # 桁落ちした画素（取り除いた寄与が残りに比べて大きすぎる）は足し直す
+        EPS = np.finfo(self.dtype).eps
+        lost = self._gauss_sum <= removed*(EPS*self.basis_num*16)
+        if np.any(lost):
+            self._gauss_sum[lost] = self._gauss[:, lost].sum(axis=0)
+            if self._numer is not None:
+                self._numer[lost] = np.tensordot(self._weights, self._gauss[:, lost], axes=1)
+        self.update_cnt += 1
+
+    def get_shape_func(
+        self,
+        weights: list[float],
+        poss: list[list[float, float]],
+        rs: (list[list[float, float]]),
+        thetas: list[float],
+    ):
+        """
+
+        正規化ガウス関数の重み付き和（形状関数）を計算する
+
+        Note:
+            前回から変化した基底の寄与だけを gauss_sum から差し引いて足し直す．
+            半数以上の基底が変化した場合と refresh_interval 回ごとにはすべて計算し直す．
+
+        """
+        assert self.basis_num == len(weights) == len(poss) == len(rs) == len(thetas)
+
+        params = (
+            np.array(poss, dtype=np.float64).reshape(-1, 2),
+            np.array(rs, dtype=np.float64).reshape(-1, 2),
+            np.array(thetas, dtype=np.float64).reshape(-1),
+        )
+        if self._params is None:
+            self._recompute(params)
+        else:
+            changed = np.any(params[0] != self._params[0], axis=1) \
+                | np.any(params[1] != self._params[1], axis=1) \
+                | (params[2] != self._params[2])
+            indices = np.flatnonzero(changed)
+            if len(indices)*2 >= self.basis_num or self.update_cnt >= self.refresh_interval:
+                self._recompute(params)
+            elif len(indices) != 0:
+                self._update(params, indices)
+        self._params = params
+
+        # 重み付き和は重みが変わったときだけ計算し直す
+        weights = np.array(weights, dtype=self.dtype)
+        if self._weights is None or not np.array_equal(weights, self._weights):
+            self._weights = weights
+            self._numer = np.tensordot(weights, self._gauss, axes=1)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self._numer/self._gauss_sum
+
+
 if __name__ == '__main__':
     np.random.seed(43)
 
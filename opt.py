@@ -1,52 +1,130 @@
-import datetime, glob
+import datetime, glob, os
+import sqlite3
+import hashlib
+import pickle
+import numpy as np
 import pandas as pd
 import sys
 sys.path.append("./python_library")
 from IO import list_to_str, str_to_list
 
 class History:
-    def __init__(self, history_dir: str):
+    """
+
+    解析結果を個体 (ind) をキーとして history ディレクトリ内の SQLite データベースに保存する
+
+    Note:
+        キーは ind を float64 の配列にしたバイト列のハッシュなので，[1, 2] と [1.0, 2.0] は同じ個体として扱う．
+        解析結果は必要になったときにデータベースから読み込む（起動時にすべて読み込むことはしない）．
+        以前の形式の history (*.csv) は初回だけデータベースに取り込む（取り込んだファイルは imported テーブルに記録する）．
+        add_many で追加した解析結果はバッファに溜めておき，flush でまとめて一つのトランザクションで書き込む．
+        evaluate は世代ごとに flush するので，プログラムが中断されても flush 済みの世代からは再開できる．
+
+    """
+    DB_NAME = "history.sqlite3"
+
+    def __init__(self, history_dir: str, synchronous: str = "NORMAL", buffer_size: int = 10000):
+        """
+
+        Args:
+            history_dir (str): history を保存するディレクトリ
+            synchronous (str): SQLite の PRAGMA synchronous（書き込みのたびにどこまで fsync するか）．
+                "OFF"（fsync しない．OS が落ちると失われうる），"NORMAL"（WAL のチェックポイント時のみ），"FULL"（コミットごと）または "EXTRA"
+            buffer_size (int): add_many のバッファに溜める解析結果の数の上限（超えたら flush する）
+
+        """
+        assert synchronous.upper() in {"OFF", "NORMAL", "FULL", "EXTRA"}
+        assert buffer_size >= 1
+
         # パス
-        date_str = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
         self.__history_dir = history_dir
-        self.__history_path = f'{self.__history_dir}/{date_str}.csv'
+        self.__db_path = f'{self.__history_dir}/{self.DB_NAME}'
+
+        # 書き込みバッファ (key をキーとする dict)
+        self.__buffer = dict()
+        self.__buffer_size = buffer_size
+
+        # データベース
+        self.__conn = sqlite3.connect(self.__db_path)
+        self.__conn.execute('PRAGMA journal_mode=WAL')
+        self.__conn.execute(f'PRAGMA synchronous={synchronous.upper()}')
+        self.__conn.execute('CREATE TABLE IF NOT EXISTS history (key BLOB PRIMARY KEY, ind TEXT, result BLOB)')
+        self.__conn.execute('CREATE TABLE IF NOT EXISTS imported (file TEXT PRIMARY KEY)')
+        self.__conn.commit()
+        self.__import_csv()     # 以前の形式の history を取り込む
+        print(f'read {len(self)} history')
 
-        # history の dict
-        self.__history = dict() # ind をキーとする dict
-        self.__read()           # 過去の計算結果を読み込む
+    @staticmethod
+    def key(ind: list) -> bytes:
+        """
+
+        ind を float64 の配列にしたバイト列のハッシュ（-0.0 は 0.0 にそろえる）
+
+        """
+        ind = np.ascontiguousarray(ind, dtype=np.float64).ravel() + 0.0
+        return hashlib.sha256(ind.tobytes()).digest()
 
-    def __read(self):
+    def __import_csv(self):
         """ 
 
-        history ディレクトリ内のすべての history を読み込む
+        history ディレクトリ内の以前の形式の history (*.csv) のうち，まだ取り込んでいないものをデータベースに取り込む
 
         """
-        for file in glob.glob(f'{self.__history_dir}/*.csv'):
+        imported = {row[0] for row in self.__conn.execute('SELECT file FROM imported')}
+        for file in sorted(glob.glob(f'{self.__history_dir}/*.csv')):
+            name = os.path.basename(file)
+            if name in imported: continue
             print('\t' + file)
+            rows = list()
             with open(file) as fileobj:
                 while True:
                     line = fileobj.readline()
                     if not line: break
                     ind = line.rstrip()
                     result = str_to_list(fileobj.readline().rstrip())
-                    self.__history[ind] = result
-        print(f'read {len(self.__history)} history')
+                    rows.append((self.key(str_to_list(ind)), ind, pickle.dumps(result)))
+            with self.__conn:
+                self.__conn.executemany('INSERT OR REPLACE INTO history VALUES (?, ?, ?)', rows)
+                self.__conn.execute('INSERT INTO imported VALUES (?)', (name,))
+
+    def __len__(self):
+        self.flush()
+        return self.__conn.execute('SELECT COUNT(*) FROM history').fetchone()[0]
 
     def add(self, ind: list, result: list):
         """
         
-        history をファイルに書き出し，プログラムメモリにも追加する
+        history をデータベースに書き込む
         
         """
-        str_ind = list_to_str(ind)
-        str_result = list_to_str(result)
+        ind = [i for i in ind]  # list に変換
+        with self.__conn:
+            self.__conn.execute('INSERT OR REPLACE INTO history VALUES (?, ?, ?)',
+                (self.key(ind), list_to_str(ind), pickle.dumps(result)))
+
+    def add_many(self, inds: list, results: list):
+        """
+
+        複数の history をバッファに追加する（flush を呼ぶか，バッファが buffer_size を超えるまで書き込まない）
+
+        """
+        assert len(inds) == len(results)
+        for ind, result in zip(inds, results):
+            ind = [i for i in ind]  # list に変換
+            key = self.key(ind)
+            self.__buffer[key] = (key, list_to_str(ind), pickle.dumps(result))
+        if len(self.__buffer) >= self.__buffer_size: self.flush()
+
+    def flush(self):
+        """
 
-        # プログラムメモリに追加
-        self.__history[str_ind] = result
+        バッファに溜めた history を一つのトランザクションでデータベースに書き込む
 
-        # ファイルに書き出し
-        with open(self.__history_path, 'a') as fileobj:
-            fileobj.write(f'{str_ind}\n{str_result}\n')
+        """
+        if not self.__buffer: return
+        with self.__conn:
+            self.__conn.executemany('INSERT OR REPLACE INTO history VALUES (?, ?, ?)', self.__buffer.values())
+        self.__buffer.clear()
 
     def get(self, ind: list):
         """
@@ -57,13 +135,24 @@ class History:
             キーが存在しなかったら None を返す
 
         """
-        ind = [i for i in ind]  # list に変換
-        ind = list_to_str(ind)
-        if ind in self.__history: return self.__history[ind]
+        key = self.key(ind)
+        if key in self.__buffer: return pickle.loads(self.__buffer[key][2])
+        row = self.__conn.execute('SELECT result FROM history WHERE key = ?', (key,)).fetchone()
+        if row is not None: return pickle.loads(row[0])
         else: return None
         
     def get_whole_history(self):
-        return self.__history
+        """
+
+        すべての history を ind の文字列 (list_to_str) をキーとする dict で返す（すべて読み込むので遅い）
+
+        """
+        self.flush()
+        return {ind: pickle.loads(result) for ind, result in self.__conn.execute('SELECT ind, result FROM history')}
+
+    def close(self):
+        self.flush()
+        self.__conn.close()
     
 
 def get_args(config: dict, pop: list):
@@ -103,8 +192,9 @@ def evaluate(pop: list, history: History, analyzer, obj_func):
     analyze_pop = [pop[i] for i in range(pop_num) if needs[i]]
     results = analyzer(analyze_pop)
     
-    # 解析結果を history に保存
-    for i in range(len(results)): history.add(analyze_pop[i], results[i])
+    # 解析結果を history に保存（世代ごとにまとめて書き込む）
+    history.add_many(analyze_pop, results)
+    history.flush()
 
     # 目的関数
     results = [history.get(ind) for ind in pop]
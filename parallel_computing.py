@@ -1,90 +1,528 @@
 """
 
-1. 並列処理したい処理を func() として定義
+1. 並列処理したい処理を関数として定義（pickle できればよい）
 2. パラメータを指定（VERBOSE, MAX_PROCESS_NUM 等）
-3. 別のファイルから multi_exec() を呼び出す
+3. 別のファイルから parallel_map(f, args) を呼び出す（multi_exec(args) は func を並列に実行する）
+   結果を完了したものから順に処理したいときは imap(f, args) を使う
+
+Note:
+    プロセスプールはプロセス数等の組ごとに初回の呼び出し時に作成し，以降の呼び出しで再利用する（プログラム終了時に閉じる）．
+    Windows 等の spawn 方式では呼び出し元を if __name__ == '__main__': で保護すること．
 
 """
+from multiprocessing import Pool, shared_memory, resource_tracker
+from collections import deque
+import numpy as np
 import traceback
-from multiprocessing import Pool
 import pickle
-import subprocess, os
+import atexit
+import copy
+import os
+import queue
+import threading
+import time
 
 
 VERBOSE = True          # 経過の出力
 MAX_PROCESS_NUM = 8
-COM_FILE = "com.bin"
+TARGET_CHUNK_TIME = 0.2 # chunksize を自動で決めるときの，ワーカーに一度に渡す仕事の目安の実行時間 [s]
+MAX_TASKS_PER_CHILD = None  # ワーカーがこの数のタスクを実行したら新しいプロセスに入れ替える（解析ライブラリのメモリリーク対策）．None なら入れ替えない
+SHARE_RESULTS = os.name == "posix"  # shared=True のとき結果も共有メモリで返すか（Windows では作成したプロセスが閉じると消えるので pickle で返す）
+
+_pools = dict()         # 再利用するプロセスプール ((プロセス数, maxtasksperchild) をキーとする dict)
 
 
 def func(arg):
     return arg**2
 
 
-def pickle_write(arg):
-    with open(COM_FILE, 'wb') as p:
-        pickle.dump(arg, p)
+def get_pool(processes: int = None, maxtasksperchild: int = None):
+    """
 
+    再利用するプロセスプールを返す（プロセス数と maxtasksperchild の組ごとに，初回の呼び出し時に作成する）
 
-def pickle_read():
-    with open(COM_FILE, 'rb') as p:
-        result = pickle.load(p)
-    os.remove(COM_FILE)
-    return result
+    Args:
+        processes (int): プロセス数．None なら MAX_PROCESS_NUM
+        maxtasksperchild (int): ワーカーを入れ替えるまでのタスク数．None なら MAX_TASKS_PER_CHILD
+
+    Note:
+        ほかの組のプールは閉じないので，別の設定で呼び出しても実行中の imap はそのまま動き続ける
+
+    """
+    key = (processes or MAX_PROCESS_NUM, maxtasksperchild or MAX_TASKS_PER_CHILD)
+    if key not in _pools: _pools[key] = _new_pool(*key)
+    return _pools[key]
+
+
+def _new_pool(processes: int, maxtasksperchild: int = None):
+    # 共有メモリを親プロセスとワーカーで同じ resource_tracker が管理するように，プール作成前に起動しておく
+    # （Windows では共有メモリを resource_tracker で管理しないし，起動もできない）
+    if os.name == "posix": resource_tracker.ensure_running()
+    return Pool(processes, maxtasksperchild=maxtasksperchild)
+
+
+def close_pool():
+    """
+
+    すべてのプロセスプールを閉じる（次の呼び出し時に作り直す）
+
+    """
+    while _pools:
+        _, pool = _pools.popitem()
+        pool.close()
+        pool.join()
+
+
+atexit.register(close_pool)
+
+
+class TaskStats:
+    """
+
+    並列実行したタスクの実行時間の統計
+
+    """
+    def __init__(self):
+        self.count = 0              # 完了したタスク数
+        self.total_time = 0.0       # タスクの実行時間の合計 [s]
+        self.min_time = float("inf")
+        self.max_time = 0.0
+        self.chunk_sizes = list()   # ワーカーに渡した仕事ごとのタスク数
+        self.elapsed_time = 0.0     # 全体の経過時間 [s]
+
+    def add(self, elapsed: float):
+        self.count += 1
+        self.total_time += elapsed
+        self.min_time = min(self.min_time, elapsed)
+        self.max_time = max(self.max_time, elapsed)
+
+    @property
+    def mean_time(self) -> float:
+        return self.total_time / self.count if self.count else 0.0
+
+    def __repr__(self):
+        return (f"TaskStats(count={self.count}, mean={self.mean_time:.4g}s, min={self.min_time:.4g}s, "
+            f"max={self.max_time:.4g}s, chunks={len(self.chunk_sizes)}, elapsed={self.elapsed_time:.4g}s)")
+
+
+class TaskResult:
+    """
+
+    タスクごとの実行結果（imap や parallel_map で return_task_results=True としたときに返す）
+
+    """
+    def __init__(self, index: int, value=None, error: BaseException = None, traceback: str = None,
+            latency: float = None, attempts: int = 0):
+        self.index = index          # args の何番目か
+        self.value = value          # f の戻り値（失敗したら None）
+        self.error = error          # 最後の試行で発生した例外（成功したら None．時間切れなら TimeoutError）
+        self.traceback = traceback  # error のトレースバック（ワーカーで整形したもの）
+        self.latency = latency      # 最後の試行の実行時間 [s]（時間切れなら None）
+        self.attempts = attempts    # 試行回数
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __repr__(self):
+        state = "ok" if self.ok else f"error={self.error!r}"
+        return f"TaskResult(index={self.index}, {state}, latency={self.latency}, attempts={self.attempts})"
+
+
+class SharedArray:
+    """
+
+    共有メモリ上に置いた np.ndarray のハンドル（pickle されるのは名前，形状，dtype だけ）
+
+    """
+    def __init__(self, name: str, shape: tuple, dtype: str):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+    @classmethod
+    def create(cls, arr: np.ndarray):
+        """
+
+        arr を新しい共有メモリにコピーし，(ハンドル, 共有メモリ) を返す
+
+        """
+        shm = shared_memory.SharedMemory(create=True, size=arr.nbytes)
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        return cls(shm.name, arr.shape, arr.dtype.str), shm
+
+    def attach(self):
+        """
+
+        共有メモリを開き，(共有メモリ上の配列, 共有メモリ) を返す（配列はコピーしない）
+
+        """
+        shm = shared_memory.SharedMemory(name=self.name)
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf), shm
+
+
+def _share(obj, blocks: list):
+    """
+
+    obj（list, tuple, dict の入れ子でもよい）に含まれる np.ndarray を共有メモリに置いてハンドルに置き換える
+
+    Args:
+        blocks (list): 作成した共有メモリを追加する
+
+    """
+    if isinstance(obj, np.ndarray) and obj.nbytes > 0:
+        handle, shm = SharedArray.create(obj)
+        blocks.append(shm)
+        return handle
+    if type(obj) in (list, tuple): return type(obj)(_share(o, blocks) for o in obj)
+    if type(obj) == dict: return {k: _share(v, blocks) for k, v in obj.items()}
+    return obj
+
+
+def _unshare(obj, blocks: list, copy: bool = False):
+    """
+
+    _share の逆．ハンドルを共有メモリ上の配列（copy が True ならそのコピー）に置き換える
+
+    Args:
+        blocks (list): 開いた共有メモリを追加する
+
+    """
+    if isinstance(obj, SharedArray):
+        arr, shm = obj.attach()
+        blocks.append(shm)
+        return arr.copy() if copy else arr
+    if type(obj) in (list, tuple): return type(obj)(_unshare(o, blocks, copy) for o in obj)
+    if type(obj) == dict: return {k: _unshare(v, blocks, copy) for k, v in obj.items()}
+    return obj
 
 
-def wrapper(process_num, query):
-    if not query: return []
-    result = []
-    for i, arg in enumerate(query):
-        result.append(func(arg))
-        if VERBOSE and process_num == 0:
-            print("\r" + "\t"*8 + f'{i+1} / {len(query)} ', end="\r")
+def _release(blocks: list, unlink: bool):
+    """
+
+    共有メモリを閉じる（unlink が True なら削除する）
+
+    """
+    for shm in blocks:
+        try: shm.close()
+        except BufferError: pass # 共有メモリ上の配列がまだ参照されている（参照がなくなれば解放される）
+        if unlink: shm.unlink()
+    blocks.clear()
+
+
+def _call_shared(f, arg):
+    """
+
+    ワーカーで共有メモリ上の引数を開いて f を実行し，結果の配列を新しい共有メモリに置いて返す（SHARE_RESULTS が False なら結果はそのまま返す）
+
+    Note:
+        引数の共有メモリは親プロセスが，結果の共有メモリは受け取った親プロセスが削除する．
+        POSIX では共有メモリは unlink するまで残るが，Windows ではすべてのハンドルが閉じると消えるので，
+        ワーカーが作った共有メモリは親プロセスが開く前に消えてしまう．そこで Windows では結果を pickle で返す．
+        このとき結果が引数の配列のビューを含んでいると，引数の共有メモリを閉じた後に参照することになるので，コピーしてから返す．
+
+    """
+    blocks = list()
+    try:
+        result = f(_unshare(arg, blocks))
+        return _share(result, list()) if SHARE_RESULTS else copy.deepcopy(result)
+    finally:
+        arg = result = None
+        _release(blocks, unlink=False)
+
+
+def _picklable(error: BaseException) -> BaseException:
+    """
+
+    親プロセスに送れない例外は，内容を文字列にした RuntimeError に置き換える
+
+    """
+    try:
+        pickle.loads(pickle.dumps(error))
+        return error
+    except Exception:
+        return RuntimeError(repr(error))
+
+
+def _run_chunk(f, chunk: list, shared: bool = False) -> list:
+    """
+
+    ワーカーで (index, arg) の組をまとめて実行し，(index, 結果, 実行時間, (例外, トレースバック) または None) の組を返す
+
+    Note:
+        f で発生した例外はタスクごとに捕まえて返すので，一つのタスクの失敗で同じ仕事のほかのタスクの結果は失われない
+
+    """
+    result = list()
+    for i, arg in chunk:
+        begin = time.perf_counter()
+        try:
+            r, error = _call_shared(f, arg) if shared else f(arg), None
+        except Exception as e:
+            r, error = None, (_picklable(e), traceback.format_exc())
+        result.append((i, r, time.perf_counter()-begin, error))
     return result
 
 
-def handler():
-    # 引数受け取り
-    query = pickle_read()
+def _discard(done: queue.Queue, blocks: dict):
+    """
+
+    実行中の仕事の完了を待ち，引数と結果の共有メモリを削除する（imap が途中で終了したとき）
+
+    """
+    while blocks:
+        key, result = done.get()
+        if key in blocks: _release(blocks.pop(key), unlink=True)
+        if isinstance(result, BaseException): continue
+        for _, r, _, _ in result:
+            received = list()
+            _unshare(r, received)
+            _release(received, unlink=True)
+
+
+def imap(f, args, ordered: bool = False, buffer_size: int = None, processes: int = None,
+        chunksize: int = None, stats: TaskStats = None, shared: bool = False,
+        timeout: float = None, retries: int = 0, maxtasksperchild: int = None, return_task_results: bool = False):
+    """
+
+    args の各要素に対して f を並列に実行し，完了したタスクから (index, 結果) を返すジェネレータ
 
-    # 空のデータが送られてきたら即返す
-    if not query:
-        pickle_write([])
-        return
+    Args:
+        f (function(arg)): 並列に実行する関数（pickle できること．lambda やローカル関数は不可）
+        args (iterable): f に渡す引数（必要になった分だけ取り出すので，ジェネレータでもよい）
+        ordered (bool): True なら index の順に返す
+        buffer_size (int): ordered が True のとき，順番待ちで保持する結果の数の上限．None ならプロセス数の 4 倍
+        processes (int): プロセス数．None なら MAX_PROCESS_NUM
+        chunksize (int): 一度にワーカーに渡す引数の数．None なら実行時間から自動で決める
+        stats (TaskStats): 指定するとタスクの実行時間の統計を書き込む
+        shared (bool): 引数と結果に含まれる np.ndarray を pickle せずに共有メモリで受け渡す（大きな配列を扱うとき）
+        timeout (float): タスクごとの制限時間 [s]．None なら制限しない
+        retries (int): 例外の発生や時間切れで失敗したタスクを再実行する回数の上限
+        maxtasksperchild (int): ワーカーを入れ替えるまでのタスク数．None なら MAX_TASKS_PER_CHILD．
+            Pool は一度に渡した仕事を一つと数えるので，指定した場合はタスクを一つずつ渡す
+        return_task_results (bool): True なら結果の代わりに TaskResult を返し，失敗したタスクがあっても例外を送出しない
 
-    processes = []
-    pool = Pool()
-    process_num = [len(query) // MAX_PROCESS_NUM for _ in range(MAX_PROCESS_NUM)]
-    for i in range(len(query) % MAX_PROCESS_NUM): process_num[i] += 1
+    Note:
+        空いたワーカーから順に次の仕事を受け取る（動的負荷分散）．ワーカーが仕事を待たないように，プロセス数の 2 倍の仕事を投入しておく．
+        chunksize が None なら，観測したタスクの平均実行時間から一度に渡す仕事が TARGET_CHUNK_TIME 程度になるように決める．
+        ただし残りのタスクが少なくなったら，最後に一部のワーカーだけが働くことがないように小さくする（args の長さがわかるときのみ）．
+        ordered が True のときは，まだ返していない最小の index から buffer_size 個先までのタスクしか投入しないので，保持する結果の数は buffer_size 以下になる．
+        shared が True なら，引数と結果に含まれる np.ndarray を共有メモリで受け渡す（仕事ごとに投入時に作成し，完了時に削除する）．
+        ただし Windows では共有メモリは最後のハンドルが閉じると消えるので，結果は共有メモリを使わず pickle で返す (SHARE_RESULTS)．
+        timeout を指定すると，タスクを一つずつプロセス数だけ投入し，投入からの経過時間で時間切れを判定する．
+        プールの個々のワーカーは止められないので，この呼び出し専用のプールを作成し（共有のプールはほかの呼び出しが使っているので止めない），
+        時間切れになったらそのプールを作り直して，実行中だったほかのタスクは試行回数に数えずに再投入する．
+        return_task_results が False のときは，retries 回再実行しても失敗したタスクの例外を送出する．
 
-    # 並列に実行
-    for i in range(MAX_PROCESS_NUM):
-        start = sum(process_num[:i])
-        end = sum(process_num[:i+1])
-        p = pool.apply_async(wrapper, args=[i, query[start:end]])
-        processes.append(p)
+    """
+    processes = processes or MAX_PROCESS_NUM
+    maxtasksperchild = maxtasksperchild or MAX_TASKS_PER_CHILD
+    private = timeout is not None   # 時間切れのときに止めるので，専用のプールを使う
+    if private: pool = _new_pool(processes, maxtasksperchild)
+    else: pool = get_pool(processes, maxtasksperchild)
+    total = len(args) if hasattr(args, "__len__") else None
+    args = iter(args)
+    buffer_size = buffer_size or 4*processes
+    assert buffer_size >= 1
+    assert retries >= 0
+    stats = stats if stats is not None else TaskStats()
+    max_running = processes if timeout is not None else 2*processes
+    inflight = dict()   # 実行中の仕事 (key: (index のリスト, 引数の共有メモリ, 期限))
+    attempts = dict()   # 完了していないタスクの (引数, 試行回数)
+    retry = deque()     # 再投入するタスクの index
+    pending = dict()    # ordered のとき，順番待ちの結果
+    done = queue.Queue()
+    begin = time.perf_counter()
+    generation = 0      # プールを作り直した回数（古いプールからの結果を無視するため）
+    submitted = 0
+    finished = 0
+    yielded = 0
+    exhausted = False
 
-    # 各プロセスの終了を順番に待つ
-    result = []
-    while processes:
-        if processes and processes[0].ready():
-            result += processes[0].get()
-            processes.pop(0)
+    def submit(indices: list):
+        key = (generation, indices[0], attempts[indices[0]][1])
+        blocks = list()
+        chunk = [(i, _share(attempts[i][0], blocks) if shared else attempts[i][0]) for i in indices]
+        for i in indices: attempts[i][1] += 1
+        deadline = time.perf_counter()+timeout if timeout is not None else None
+        inflight[key] = (indices, blocks, deadline)
+        pool.apply_async(_run_chunk, (f, chunk, shared),
+            callback=lambda result, key=key: done.put((key, result)),
+            error_callback=lambda error, key=key: done.put((key, error)))
+        stats.chunk_sizes.append(len(chunk))
 
-    pickle_write(result)
+    def fail(i: int, error: BaseException, tb: str, latency: float):
+        # 再実行できなければ失敗を確定する
+        n = attempts[i][1]
+        if n <= retries:
+            retry.append(i)
+            return None
+        attempts.pop(i)
+        return TaskResult(i, error=error, traceback=tb, latency=latency, attempts=n)
+
+    try:
+        while True:
+            # 仕事を投入（再実行するタスクを優先する）
+            while len(inflight) < max_running and retry:
+                submit([retry.popleft()])
+            while len(inflight) < max_running and not exhausted:
+                size = chunksize
+                if size is None:
+                    size = max(1, round(TARGET_CHUNK_TIME / max(stats.mean_time, 1e-6))) if stats.count else 1 # 時計の分解能が粗いと 0 になりうる
+                    if total is not None: size = min(size, max(1, (total-submitted) // (2*processes)))
+                if timeout is not None or maxtasksperchild is not None: size = 1
+                if ordered: size = min(size, yielded+buffer_size-submitted)
+                if size <= 0: break
+                indices = list()
+                for _ in range(size):
+                    try: arg = next(args)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    attempts[submitted] = [arg, 0]
+                    indices.append(submitted)
+                    submitted += 1
+                if not indices: break
+                submit(indices)
+            if not inflight: break
+
+            # 完了した仕事を受け取る（待機中は CPU を使わない）
+            outputs = list()
+            try:
+                wait = None
+                if timeout is not None: wait = max(0, min(d for _, _, d in inflight.values())-time.perf_counter())
+                key, result = done.get(timeout=wait)
+            except queue.Empty:
+                # 時間切れのタスクを失敗とし，プールを作り直してほかの実行中のタスクを再投入する
+                now = time.perf_counter()
+                for key, (indices, blocks, deadline) in list(inflight.items()):
+                    del inflight[key]
+                    _release(blocks, unlink=True)
+                    for i in indices:
+                        if deadline <= now:
+                            output = fail(i, TimeoutError(f"task {i} timed out after {timeout} s"), None, None)
+                            if output is not None: outputs.append(output)
+                        else:
+                            attempts[i][1] -= 1
+                            retry.appendleft(i)
+                pool.terminate()
+                pool.join()
+                pool = _new_pool(processes, maxtasksperchild)
+                generation += 1
+                key, result = None, None
+            if key is not None and key not in inflight:
+                # 作り直す前のプールからの結果
+                if not isinstance(result, BaseException) and shared:
+                    for _, r, _, _ in result:
+                        received = list()
+                        _unshare(r, received)
+                        _release(received, unlink=True)
+                key = None
+            if key is not None:
+                indices, blocks, _ = inflight.pop(key)
+                _release(blocks, unlink=True)
+                if isinstance(result, BaseException):
+                    # 結果を送れなかった等，タスクの外で発生した例外
+                    result = [(i, None, None, (result, None)) for i in indices]
+                for i, r, elapsed, error in result:
+                    if elapsed is not None: stats.add(elapsed)
+                    if error is not None:
+                        output = fail(i, *error, elapsed)
+                        if output is not None: outputs.append(output)
+                        continue
+                    if shared:
+                        received = list()
+                        r = _unshare(r, received, copy=True)
+                        _release(received, unlink=True)
+                    n = attempts.pop(i)[1]
+                    outputs.append(TaskResult(i, value=r, latency=elapsed, attempts=n))
+
+            # 失敗を確定したタスクの例外は，受け取った仕事を処理し終えてから送出する
+            for output in outputs:
+                if not (return_task_results or output.ok): raise output.error
+                i, r = output.index, output if return_task_results else output.value
+                finished += 1
+                if ordered: pending[i] = r
+                else:
+                    yielded += 1
+                    yield i, r
+            stats.elapsed_time = time.perf_counter()-begin
+            if VERBOSE: print("\r" + "\t"*8 + f'{finished} / {total if total is not None else "?"} ', end="\r")
+            while yielded in pending:
+                yielded += 1
+                yield yielded-1, pending.pop(yielded-1)
+    finally:
+        # 専用のプールは閉じる（途中で終了したら実行中のタスクも止めて，共有メモリを削除する）
+        if private:
+            if inflight: pool.terminate()
+            else: pool.close()
+            pool.join()
+            for _, blocks, _ in inflight.values(): _release(blocks, unlink=True)
+        # 途中で終了したら，実行中の仕事の完了を別スレッドで待って共有メモリを削除する
+        elif shared and inflight:
+            blocks = {key: blocks for key, (_, blocks, _) in inflight.items()}
+            threading.Thread(target=_discard, args=(done, blocks), daemon=True).start()
+
+
+def parallel_map(f, args, processes: int = None, chunksize: int = None, stats: TaskStats = None, shared: bool = False,
+        timeout: float = None, retries: int = 0, maxtasksperchild: int = None, return_task_results: bool = False) -> list:
+    """
+
+    args の各要素に対して f を並列に実行し，結果を args と同じ順に返す（引数の意味は imap と同じ）
+
+    Note:
+        結果は完了したものから順に受け取る（ファイルは介さず，待機中は CPU を使わない）
+
+    """
+    args = list(args)
+    result = [None]*len(args)
+    for i, r in imap(f, args, processes=processes, chunksize=chunksize, stats=stats, shared=shared,
+            timeout=timeout, retries=retries, maxtasksperchild=maxtasksperchild, return_task_results=return_task_results):
+        result[i] = r
+    return result
 
 
 def multi_exec(args, python3=False):
-    pickle_write(args)
-    py = "python"
-    if python3: py += "3"
-    subprocess.run([py, __file__])
-    return pickle_read()
+    """
+
+    args の各要素に対して func を並列に実行する（互換のために残している．python3 は使わない）
+
+    """
+    return parallel_map(func, args)
+
+
+def _sleep(t):
+    time.sleep(t)
+    return t
+
+
+def _normalize(arr):
+    return arr / arr.sum()
+
+
+def _flaky(i):
+    if i % 5 == 1: raise ValueError(f"failed: {i}")
+    if i % 5 == 2: time.sleep(10)
+    return i
 
 
 if __name__ == '__main__':
-    try:
-        handler()
-    except SystemExit:
-        pass
-    except:
-        print(traceback.format_exc())
+    print(multi_exec(list(range(20))))
+
+    # 実行時間にばらつきがあるタスク
+    stats = TaskStats()
+    parallel_map(_sleep, [0.5 if i % 50 == 0 else 0.001 for i in range(1000)], stats=stats)
+    print(stats)
+
+    # 大きな配列を共有メモリで受け渡す
+    arrs = [np.random.rand(1000, 1000) for _ in range(16)]
+    results = parallel_map(_normalize, arrs, shared=True)
+    print(all(np.allclose(r, a / a.sum()) for r, a in zip(results, arrs)))
+
+    # 完了したものから順に受け取る
+    for i, r in imap(_sleep, (0.01*(i % 7) for i in range(50)), ordered=True, buffer_size=8):
+        assert r == 0.01*(i % 7)
+
+    # 失敗や時間切れになるタスクがあっても，タスクごとの結果を受け取る
+    for result in parallel_map(_flaky, range(10), timeout=1, retries=1, return_task_results=True):
+        print(result)
@@ -3,38 +3,75 @@ import cv2
 import sys
 sys.path.append("./python_library")
 from algorithm import FloodFill, UnionFind
+from IO import list_to_str, str_to_list
 import copy
 import multiprocessing
 import uuid
 import os
 import subprocess
+import ctypes
+import time
+import queue
+import hashlib
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 
+CXX_DIR = Path(__file__).parent / "polygon_decomposer"
+CXX_EXE_PATH = CXX_DIR / ("cxx_decompose.exe" if os.name == "nt" else "cxx_decompose")
+
+
 class PolygonDecomposer:
     DI = [0, 1, 0, -1]
     DJ = [1, 0, -1, 0]
+    _native = None  # ctypes で読み込んだ C++ 版の共有ライブラリ（読み込めなかった場合は False）
+    _binary = None  # 実行ファイルが --binary, --server に対応しているか（古い実行ファイルは一時ファイルでしか受け渡せない）
 
     @staticmethod
-    def draw_from_polygons(shape: tuple, geometry: list):
+    def _to_cv2_polygons(polygons: list, scale: int = 1):
+        """ 一つの階層の多角形を cv2.fillPoly に渡す形式 (int32, (x, y) = (j, i)) に変換する """
+        return [(np.asarray(vertex, dtype=np.int32)*scale)[:, ::-1].reshape(-1, 1, 2) for vertex in polygons]
+
+    @classmethod
+    def draw_from_polygons(cls, shape: tuple, geometry: list):
         """
         
         分解した多角形をもとに画像を作成
+
+        Note:
+            各階層の多角形は一度の cv2.fillPoly でまとめて塗りつぶす（同じ階層の多角形は重ならない）
         
         """
         WHITE = (int(255), int(255), int(255))
         BLACK = (int(0), int(0), int(0))
 
         img = np.full(shape=shape, fill_value=255, dtype=np.uint8)
-        for i, vertices in enumerate(geometry):
-            for vertex in vertices:
-                cv2.fillPoly(
-                    img,
-                    np.array([(j, i) for i, j in vertex]).reshape(1, -1, 2),
-                    color=BLACK if i % 2 == 0 else WHITE
-                )
+        for i, polygons in enumerate(geometry):
+            if not polygons: continue
+            cv2.fillPoly(img, cls._to_cv2_polygons(polygons), color=BLACK if i % 2 == 0 else WHITE)
         return img
 
+    @classmethod
+    def verify(cls, img: np.ndarray, geometry: list) -> int:
+        """
+
+        分解した多角形から元の二値画像を復元し，一致しない画素数を返す（0 なら完全に復元できる）
+
+        Note:
+            geometry の頂点は画素の角の座標で，x+, y+ 側は閉区間として +1 されているため，
+            draw_from_polygons で描くと境界の 1px がずれる．そこで座標を二倍した格子に全階層を順に描き，
+            各画素の中心 (2i+1, 2j+1) が塗られているかで判定する（階層ごとに画像を確保しない）．
+
+        """
+        assert len(img.shape) == 2
+        H, W = img.shape
+        canvas = np.full((2*H+1, 2*W+1), 255, dtype=np.uint8)
+        for i, polygons in enumerate(geometry):
+            if not polygons: continue
+            cv2.fillPoly(canvas, cls._to_cv2_polygons(polygons, scale=2), color=0 if i % 2 == 0 else 255)
+        return int(np.count_nonzero(canvas[1::2, 1::2] != img))
+
     @staticmethod
     def is_polygon_inside(points_: list[tuple[float, float]], judge_point: tuple[float, float]):
         """
@@ -62,6 +99,119 @@ class PolygonDecomposer:
         wn = theta / (2.0*np.pi)
         return wn > 1.0-EPS
 
+    @staticmethod
+    def _points_inside_polygon(points: np.ndarray, polygon: np.ndarray, chunk: int = 1 << 22):
+        """
+
+        多角形の全ての辺と全ての点の組で交差数を数えて内外判定する (Crossing Number Algorithm)
+
+        Note:
+            境界（辺・頂点）上の点は内側とする．メモリを抑えるため (辺数 x 点数) が chunk 程度になるよう点を分割する．
+
+        """
+        x1, y1 = polygon[:, 0:1], polygon[:, 1:2]
+        x2, y2 = np.roll(x1, -1, axis=0), np.roll(y1, -1, axis=0)
+        EPS = 1E-9 * max(1.0, float(np.abs(polygon).max()))
+        step = max(1, chunk // len(polygon))
+        ret = np.zeros(len(points), dtype=bool)
+        for begin in range(0, len(points), step):
+            px = points[None, begin:begin+step, 0]
+            py = points[None, begin:begin+step, 1]
+
+            # 点から x+ 方向に伸ばした半直線と交わる辺の数
+            straddle = (y1 > py) != (y2 > py)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                x_cross = x1 + (x2-x1)*(py-y1)/(y2-y1)
+            inside = np.count_nonzero(straddle & (px < x_cross), axis=0) % 2 == 1
+
+            # 辺上の点
+            cross = (x2-x1)*(py-y1) - (y2-y1)*(px-x1)
+            on_edge = (np.abs(cross) <= EPS*(np.abs(x2-x1)+np.abs(y2-y1))) \
+                & (np.minimum(x1, x2)-EPS <= px) & (px <= np.maximum(x1, x2)+EPS) \
+                & (np.minimum(y1, y2)-EPS <= py) & (py <= np.maximum(y1, y2)+EPS)
+            ret[begin:begin+step] = inside | np.any(on_edge, axis=0)
+        return ret
+
+    @staticmethod
+    def _points_inside_polygon_raster(points: np.ndarray, polygon: np.ndarray, canvas: np.ndarray, offset: np.ndarray):
+        """ cv2.fillPoly で塗りつぶした画像を参照して内外判定する（格子点のみ） """
+        canvas[:] = 0
+        cv2.fillPoly(canvas, [(polygon - offset)[:, ::-1].astype(np.int32).reshape(-1, 1, 2)], color=1)
+        index = points - offset
+        return canvas[index[:, 0], index[:, 1]].astype(bool)
+
+    @classmethod
+    def is_points_inside(cls, points: np.ndarray, polygons: list, rasterize: bool = False):
+        """
+
+        複数の点をまとめて多角形に対して内外判定する
+
+        Args:
+            points (np.ndarray): 判定する点 (N, 2)
+            polygons (list): 多角形の頂点のリスト，またはそれを並べたリスト
+            rasterize (bool): cv2.fillPoly で塗りつぶした画像を参照して判定する．点と頂点がすべて整数の場合のみ．密な格子点の判定で速い．
+
+        Returns:
+            np.ndarray: 多角形が一つなら (N,)，複数なら (len(polygons), N) の bool 配列
+
+        Note:
+            is_polygon_inside と違い頂点の向き（時計回りかどうか）に依らない．境界（辺・頂点）上の点は内側とする．
+            rasterize では辺を cv2.fillPoly の描画で判定するので，辺が軸に平行でない多角形では境界付近が厳密でない．
+
+        """
+        points = np.asarray(points).reshape(-1, 2)
+        single = np.ndim(polygons[0][0]) == 0
+        if single: polygons = [polygons]
+        polygons = [np.asarray(polygon).reshape(-1, 2) for polygon in polygons]
+
+        if rasterize:
+            assert all(np.array_equal(a, np.round(a)) for a in [points] + polygons), "rasterize requires integer coordinates."
+            points = points.astype(np.int64)
+            polygons = [polygon.astype(np.int64) for polygon in polygons]
+            all_points = np.concatenate([points] + polygons)
+            offset = all_points.min(axis=0)
+            canvas = np.zeros(all_points.max(axis=0) - offset + 1, dtype=np.uint8)
+            ret = np.stack([cls._points_inside_polygon_raster(points, polygon, canvas, offset) for polygon in polygons])
+        else:
+            points = points.astype(np.float64)
+            ret = np.stack([cls._points_inside_polygon(points, polygon.astype(np.float64)) for polygon in polygons])
+        return ret[0] if single else ret
+
+    @staticmethod
+    def _label_regions(mask: np.ndarray, return_bboxes: bool = False):
+        """
+
+        二値マスクを 4 近傍の連結成分にラベリングする
+
+        Returns:
+            labels (np.ndarray): ラベル画像 (int32)．0 はマスク外，連結成分は 1, 2, ...
+            firsts (np.ndarray): ラベル 1, 2, ... の連結成分を代表する画素（ラスタ順で最初の画素）のインデックス
+            bboxes (np.ndarray): return_bboxes が True の場合のみ．各連結成分の外接矩形 (top, left, bottom, right)（閉区間）
+
+        """
+        mask = np.ascontiguousarray(mask, dtype=bool).view(np.uint8)
+        n, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=4, ltype=cv2.CV_32S)
+        if n == 1:
+            firsts = np.zeros(0, dtype=np.int64)
+        else:
+            # 各連結成分の最上行にある画素のうち，ラスタ順で最初のものが代表点
+            top = np.zeros(n, dtype=np.int64)
+            top[1:] = stats[1:, cv2.CC_STAT_TOP]
+            rows = np.arange(mask.shape[0])[:, None]
+            candidates = np.flatnonzero((labels != 0) & (top[labels] == rows))
+            _, first = np.unique(labels.ravel()[candidates], return_index=True)
+            firsts = candidates[first]
+        if not return_bboxes: return labels, firsts
+
+        stats = stats[1:].astype(np.int64)
+        bboxes = np.stack([
+            stats[:, cv2.CC_STAT_TOP],
+            stats[:, cv2.CC_STAT_LEFT],
+            stats[:, cv2.CC_STAT_TOP]+stats[:, cv2.CC_STAT_HEIGHT]-1,
+            stats[:, cv2.CC_STAT_LEFT]+stats[:, cv2.CC_STAT_WIDTH]-1,
+        ], axis=1).reshape(-1, 4)
+        return labels, firsts, bboxes
+
     @classmethod
     def _extract_boundary_vertices(cls, img: np.ndarray):
         """
@@ -69,22 +219,10 @@ class PolygonDecomposer:
         入力された二値画像の境界を抽出する
         
         """
-        to = lambda i, j: i*(img.shape[1])+j
-        to_ = lambda x: (int(x/img.shape[1]), x%img.shape[1])
-        uf = UnionFind(img.shape[0]*img.shape[1])
-        for i in range(img.shape[0]):
-            for j in range(img.shape[1]):
-                for ii, jj in zip(cls.DI, cls.DJ):
-                    ni, nj = i+ii, j+jj
-                    if not 0 <= ni < img.shape[0]: continue
-                    if not 0 <= nj < img.shape[1]: continue
-                    if img[i, j] != img[ni, nj]: continue
-                    uf.union(to(i, j), to(ni, nj))
-
-        # 各グループを代表する座標を取得
-        begins = list()
-        for group in uf.all_group_members().values():
-            if img[to_(min(group))] == 255: begins.append(to_(min(group)))
+        # 白の各領域を代表する座標（ラスタ順で最初の画素）を取得
+        _, firsts = cls._label_regions(img == 255)
+        W = img.shape[1]
+        begins = [(int(x // W), int(x % W)) for x in np.sort(firsts)]
         
         # 境界の節点を抽出
         return [cls._extract_boundary_vertex(img, begin) for begin in begins]
@@ -94,71 +232,283 @@ class PolygonDecomposer:
         """
         
         入力された二値画像のうち，指定された座標 (begin) を含む領域の境界を抽出する
-        
+
+        画素そのものではなく画素の角（格子点）を結ぶ辺をたどるので，幅が 1px の形状もそのまま扱える．
+        begin は領域のラスタ順で最初の画素とし，その左上の角から領域を右手に見ながら（時計回りに）たどる．
+
+        Returns:
+            vertices (list): 境界の頂点（格子点の座標）．格子点 (i, j) は画素 (i, j) の左上の角
+
         """
-        # 境界を抽出する
-        boundary = [begin]
-        search_cnt = 0
+        H, W = img.shape
+        color = img[begin]
+        def inside(i, j): return 0 <= i < H and 0 <= j < W and img[i, j] == color
+
+        # 進行方向 d (右，下，左，上) に対して，格子点の左前方と右前方にある画素
+        LI, LJ = (-1, 0, 0, -1), (0, 0, -1, -1)
+        RI, RJ = (0, 0, -1, -1), (0, -1, -1, 0)
+
+        vertices = [begin]
+        i, j = begin
+        d = 0
         while True:
-            bi, bj = boundary[-1]
-            for k in range(4):
-                i = bi+cls.DI[(search_cnt+k)%4]
-                j = bj+cls.DJ[(search_cnt+k)%4]
-                if not 0 <= i < img.shape[0]: continue
-                if not 0 <= j < img.shape[1]: continue
-                if img[i, j] == img[begin]:
-                    boundary.append((i, j))
-                    search_cnt = (search_cnt+k-1)%4
-                    break
-            if len(boundary) > 1 and boundary[0] == boundary[-1]: break
-
-        # 境界から頂点を抽出する
-        vertices = [boundary[0]]
-        for k in range(1, len(boundary)-1):
-            i1, j1 = boundary[k-1]
-            i2, j2 = boundary[k]
-            i3, j3 = boundary[k+1]
-            if i1 == i2 == i3: continue
-            if j1 == j2 == j3: continue
-            vertices.append(boundary[k])
+            i += cls.DI[d]
+            j += cls.DJ[d]
+            if (i, j) == begin: break
+            if not inside(i+RI[d], j+RJ[d]): d = (d+1)%4 # 右に曲がる
+            elif inside(i+LI[d], j+LJ[d]): d = (d-1)%4 # 左に曲がる
+            else: continue
+            vertices.append((i, j))
         return vertices
 
     @classmethod
-    def decompose(cls, img_: np.ndarray):
+    def _label_all_regions(cls, img: np.ndarray, return_bboxes: bool = False):
         """
-        
-        入力された二値画像を多角形の重ね合わせに分解する
 
-        BUG: 幅が 1px の長方形を含むときに正常動作しない → 画像を二倍して処理することにした
-        TODO: OpenCV を使って輪郭抽出すれば高速化できそう → 厳密に輪郭を抽出できなかった（角近傍で近似されてしまう）
-        
+        二値画像の白と黒の両方を 4 近傍の同色領域にラベリングする（白の領域が先，黒の領域が後）
+
+        Returns:
+            regions (np.ndarray): 領域のラベル画像 (0, 1, ..., R-1)
+            firsts (np.ndarray): 各領域のラスタ順で最初の画素のインデックス (R,)
+            bboxes (np.ndarray): return_bboxes が True の場合のみ．各領域の外接矩形 (R, 4)
+
         """
-        assert type(img_) == np.ndarray
-        assert img_.dtype == np.uint8
-        assert np.all((img_ == 0) | (img_ == 255))
-        assert len(img_.shape) == 2 # 1 チャンネル画像
-        img = img_.copy()
+        white = cls._label_regions(img == 255, return_bboxes)
+        black = cls._label_regions(img == 0, return_bboxes)
+        regions = np.where(img == 255, white[0]-1, black[0]-1+len(white[1]))
+        ret = (regions,) + tuple(np.concatenate([w, b]) for w, b in zip(white[1:], black[1:]))
+        return ret if return_bboxes else ret[:2]
 
-        # 幅が 1 の形状があると輪郭の追跡が大変だから二倍する
-        img = cv2.resize(img, (img.shape[1]*2, img.shape[0]*2), interpolation=cv2.INTER_NEAREST)
+    @staticmethod
+    def _adjacent_pairs(regions: np.ndarray) -> np.ndarray:
+        """
 
-        # 外周を追加
-        img = np.insert(img, 0, 255, axis=0)
-        img = np.insert(img, img.shape[0], 255, axis=0)
-        img = np.insert(img, 0, 255, axis=1)
-        img = np.insert(img, img.shape[1], 255, axis=1)
+        ラベル画像で上下左右に隣接する異なる領域の組（領域の隣接グラフの辺）を求める
+
+        Returns:
+            edges (np.ndarray): 領域の組 (E, 2)．各行は (小さいラベル, 大きいラベル) で重複はない
+
+        """
+        a = np.concatenate([regions[:, :-1].ravel(), regions[:-1, :].ravel()])
+        b = np.concatenate([regions[:, 1:].ravel(), regions[1:, :].ravel()])
+        adjacent = a != b
+        return np.unique(np.stack([
+            np.minimum(a[adjacent], b[adjacent]),
+            np.maximum(a[adjacent], b[adjacent]),
+        ], axis=1), axis=0).reshape(-1, 2)
+
+    @staticmethod
+    def _bfs_depths(R: int, root: int, edges: np.ndarray) -> np.ndarray:
+        """
+
+        領域の隣接グラフを root から幅優先探索し，各領域の深さを求める
+
+        """
+        depths = np.full(R, -1, dtype=np.int64)
+        depths[root] = 0
+        frontier = np.zeros(R, dtype=bool)
+        frontier[root] = True
+        depth = 0
+        while True:
+            nexts = np.concatenate([edges[frontier[edges[:, 0]], 1], edges[frontier[edges[:, 1]], 0]])
+            nexts = nexts[depths[nexts] < 0]
+            if len(nexts) == 0: break
+            depth += 1
+            depths[nexts] = depth
+            frontier[:] = False
+            frontier[nexts] = True
+        assert np.all(depths >= 0)
+        return depths
+
+    @classmethod
+    def _region_depths(cls, img: np.ndarray):
+        """
+
+        二値画像を 4 近傍の同色領域にラベリングし，各領域の入れ子の深さ（左上の領域からたどる隣接領域の数）を求める
+
+        Returns:
+            regions (np.ndarray): 領域のラベル画像 (0, 1, ..., R-1)
+            depths (np.ndarray): 各領域の深さ (R,)
+            firsts (np.ndarray): 各領域のラスタ順で最初の画素のインデックス (R,)
+            edges (np.ndarray): 隣接する領域の組 (E, 2)
+
+        """
+        regions, firsts = cls._label_all_regions(img)
+        edges = cls._adjacent_pairs(regions)
+        depths = cls._bfs_depths(len(firsts), regions[0, 0], edges)
+        return regions, depths, firsts, edges
+
+    @staticmethod
+    def _level_components(depths: np.ndarray, edges: np.ndarray) -> list:
+        """
+
+        深さ k ごとに，深さが k より大きい領域どうしの連結成分を求める
+
+        Returns:
+            levels (list): levels[k] = (inside, roots)．inside は深さが k より大きい領域，roots は各領域が属する連結成分の代表
+
+        """
+        max_depth = int(depths.max())
+
+        # 深いほうから順に，両端の深さが k より大きい辺で領域を統合していく
+        uf = UnionFind(len(depths))
+        edge_depths = np.minimum(depths[edges[:, 0]], depths[edges[:, 1]])
+        levels = [None]*max_depth
+        for k in reversed(range(max_depth)):
+            active = edge_depths == k+1
+            uf.union_many(edges[active, 0], edges[active, 1])
+            inside = np.flatnonzero(depths > k)
+            levels[k] = (inside, uf.labels()[inside])
+        return levels
+
+    @classmethod
+    def _decompose_hierarchy(cls, img: np.ndarray):
+        """
+
+        領域の隣接グラフから入れ子の深さを一度に求め，深さごとに境界を抽出する
+
+        Note:
+            深さ k の境界は「深さが k より大きい画素」の連結成分の境界で，
+            _decompose_flood_fill で k 回目に塗りつぶされずに残る部分と一致する
+
+        """
+        regions, depths, firsts, edges = cls._region_depths(img)
+        if len(edges) == 0: return list()
+        depth_img = depths[regions]
 
-        # 交互に塗りつぶしながら境界を抽出
+        geometry = list()
+        W = img.shape[1]
+        for k, (inside, roots) in enumerate(cls._level_components(depths, edges)):
+            component_firsts = np.full(len(depths), img.size, dtype=np.int64)
+            np.minimum.at(component_firsts, roots, firsts[inside])
+            begins = [(int(x // W), int(x % W)) for x in np.sort(component_firsts[component_firsts < img.size])]
+            diff = np.where(depth_img > k, 255, 0).astype(np.uint8)
+            geometry.append([cls._extract_boundary_vertex(diff, begin) for begin in begins])
+        return geometry
+
+    @classmethod
+    def _label_tile(cls, tile: np.ndarray):
+        """
+
+        タイル内の領域をラベリングし，タイル内で隣接する領域の組を求める（_decompose_tiled のワーカー）
+
+        """
+        regions, firsts, bboxes = cls._label_all_regions(tile, return_bboxes=True)
+        return regions, firsts, bboxes, cls._adjacent_pairs(regions)
+
+    @classmethod
+    def _trace_component(cls, args: tuple) -> list:
+        """
+
+        切り出した画像で境界を抽出し，元の画像の座標に戻す（_decompose_tiled のワーカー）
+
+        """
+        crop, begin, (oi, oj) = args
+        return [(i+oi, j+oj) for i, j in cls._extract_boundary_vertex(crop, begin)]
+
+    @classmethod
+    def _decompose_tiled(cls, img: np.ndarray, tile_size: int = 1024, processes: int = None):
+        """
+
+        画像をタイルに分けてプロセスプールでラベリングし，タイルの継ぎ目で領域をつなぎ合わせてから，
+        連結成分ごとに外接矩形で切り出した画像で境界を並列に抽出する（結果は _decompose_hierarchy と同じ）
+
+        Args:
+            tile_size (int): タイルの一辺の画素数（外周を追加した画像上）
+            processes (int): プロセス数．None なら CPU 数，1 ならプールを使わない
+
+        """
+        assert tile_size >= 1
+        processes = processes or os.cpu_count()
+        H, W = img.shape
+        tiles = [(i, j) for i in range(0, H, tile_size) for j in range(0, W, tile_size)]
+        pool = multiprocessing.Pool(processes) if processes > 1 else None
+        try:
+            mapper = pool.map if pool is not None else lambda f, xs: list(map(f, xs))
+
+            # タイルごとのラベルに通し番号を振り，タイル内の代表点と外接矩形を画像全体の座標に直す
+            regions = np.empty((H, W), dtype=np.int32)
+            firsts, bboxes, edges = list(), list(), list()
+            offset = 0
+            results = mapper(cls._label_tile, [img[i:i+tile_size, j:j+tile_size] for i, j in tiles])
+            for (i, j), (tile_regions, tile_firsts, tile_bboxes, tile_edges) in zip(tiles, results):
+                w = tile_regions.shape[1]
+                regions[i:i+tile_size, j:j+tile_size] = tile_regions+offset
+                firsts.append((tile_firsts // w + i)*W + tile_firsts % w + j)
+                bboxes.append(tile_bboxes + (i, j, i, j))
+                edges.append(tile_edges+offset)
+                offset += len(tile_firsts)
+            firsts = np.concatenate(firsts)
+            bboxes = np.concatenate(bboxes)
+            edges = np.concatenate(edges)
+
+            # タイルの継ぎ目で隣接する同色の領域を統合し，異色の領域の組を隣接グラフの辺に加える
+            cols = list(range(tile_size, W, tile_size))
+            rows = list(range(tile_size, H, tile_size))
+            a = np.concatenate([regions[:, j-1] for j in cols] + [regions[i-1, :] for i in rows] + [np.zeros(0, np.int32)])
+            b = np.concatenate([regions[:, j] for j in cols] + [regions[i, :] for i in rows] + [np.zeros(0, np.int32)])
+            same = np.concatenate([img[:, j-1] == img[:, j] for j in cols] + [img[i-1, :] == img[i, :] for i in rows] + [np.zeros(0, bool)])
+            uf = UnionFind(offset)
+            uf.union_many(a[same], b[same])
+            _, compact = np.unique(uf.labels(), return_inverse=True)
+            R = int(compact.max())+1
+            regions = compact.astype(np.int32)[regions]
+            region_firsts = np.full(R, img.size, dtype=np.int64)
+            np.minimum.at(region_firsts, compact, firsts)
+            region_bboxes = np.empty((R, 4), dtype=np.int64)
+            region_bboxes[:, :2] = max(H, W)
+            region_bboxes[:, 2:] = -1
+            np.minimum.at(region_bboxes[:, :2], compact, bboxes[:, :2])
+            np.maximum.at(region_bboxes[:, 2:], compact, bboxes[:, 2:])
+            edges = compact[np.concatenate([edges, np.stack([a[~same], b[~same]], axis=1)])]
+            edges = np.unique(np.sort(edges, axis=1), axis=0).reshape(-1, 2)
+            if len(edges) == 0: return list()
+            depths = cls._bfs_depths(R, regions[0, 0], edges)
+
+            # 深さごとの連結成分を代表点の順に並べ，外接矩形で切り出した画像で境界を抽出する
+            tasks, counts = list(), list()
+            for k, (inside, roots) in enumerate(cls._level_components(depths, edges)):
+                _, component = np.unique(roots, return_inverse=True)
+                C = int(component.max())+1
+                component_firsts = np.full(C, img.size, dtype=np.int64)
+                np.minimum.at(component_firsts, component, region_firsts[inside])
+                component_bboxes = np.empty((C, 4), dtype=np.int64)
+                component_bboxes[:, :2] = max(H, W)
+                component_bboxes[:, 2:] = -1
+                np.minimum.at(component_bboxes[:, :2], component, region_bboxes[inside, :2])
+                np.maximum.at(component_bboxes[:, 2:], component, region_bboxes[inside, 2:])
+                for c in np.argsort(component_firsts):
+                    top, left, bottom, right = component_bboxes[c]
+                    crop = np.where(depths[regions[top:bottom+1, left:right+1]] > k, 255, 0).astype(np.uint8)
+                    begin = (int(component_firsts[c] // W - top), int(component_firsts[c] % W - left))
+                    tasks.append((crop, begin, (int(top), int(left))))
+                counts.append(C)
+            if pool is None or len(tasks) == 1: results = list(map(cls._trace_component, tasks))
+            else: results = pool.map(cls._trace_component, tasks, chunksize=max(1, len(tasks) // (4*processes)))
+        finally:
+            if pool is not None: pool.close()
+
+        bounds = np.cumsum([0] + counts)
+        return [results[bounds[k]:bounds[k+1]] for k in range(len(counts))]
+
+    @classmethod
+    def _decompose_flood_fill(cls, img: np.ndarray):
+        """
+
+        外側から交互に塗りつぶしながら境界を抽出する（深さの数だけ画像全体を塗りつぶす）
+
+        """
         geometry = list()
         cnt = 0
         while True:
             tmp = img.copy()
-            FloodFill.queue(
+            FloodFill.fill(
                 arr=tmp,
                 begin_y=0,
                 begin_x=0,
                 rcolor=0 if cnt % 2 == 0 else 255,
                 direction=4,
+                method="label",
             )
             diff = (255 - np.abs(img.astype(int) - tmp.astype(int))).astype(np.uint8)
             # cv2.imwrite(f"{cnt}_original.bmp", img)
@@ -168,44 +518,155 @@ class PolygonDecomposer:
             cnt += 1
             if np.array_equal(diff, np.zeros(diff.shape, dtype=np.uint8)): break
             else: geometry.append(cls._extract_boundary_vertices(diff))
+        return geometry
 
-        # x+ および y+ 側の境界は +2 する（ピクセル上では半開区間で表現されているがモデリング時には閉区間で形状を指定するから）
-        # +1 じゃなくて +2 なのは元画像を二倍しているから
-        # 外周を追加した分を差し引く
-        for i in range(len(geometry)):
-            for j in range(len(geometry[i])):
-                shift = list()
-                points = copy.deepcopy(geometry[i][j])
-                points = [points[-1]] + points + [points[0]]
-                for k in range(1, len(points)-1):
-                    assert len(points[k]) == 2
-                    i1, j1 = points[k-1]
-                    i2, j2 = points[k]
-                    i3, j3 = points[k+1]
-                    di1, di2 = i2-i1, i3-i2
-                    dj1, dj2 = j2-j1, j3-j2
-                    assert (di1==0 and di2!=0 and dj1!=0 and dj2==0) or \
-                        (di1!=0 and di2==0 and dj1==0 and dj2!=0)
-                    shift.append((2 if dj1 < 0 or dj2 < 0 else 0, 2 if di1 > 0 or di2 > 0 else 0))
-                assert len(shift) == len(geometry[i][j])
-                for k in range(len(shift)):
-                    ii, jj = shift[k]
-                    geometry[i][j][k] = (geometry[i][j][k][0]+ii-1, geometry[i][j][k][1]+jj-1)
-
-        # 二倍した分をもとに戻す
-        for i in range(len(geometry)):
-            for j in range(len(geometry[i])):
-                for k in range(len(geometry[i][j])):
-                    geometry[i][j][k] = [int(geometry[i][j][k][0]*0.5), int(geometry[i][j][k][1]*0.5)]
+    @staticmethod
+    def _finalize_geometry(geometry: list):
+        """
 
-        return geometry
+        外周を追加した画像上の境界の頂点（格子点）を元画像の座標に戻す
+
+        """
+        return [[[[int(i)-1, int(j)-1] for i, j in polygon] for polygon in polygons] for polygons in geometry]
+
+    @classmethod
+    def decompose(cls, img_: np.ndarray, method: str = "hierarchy", tile_size: int = 1024, processes: int = None):
+        """
+        
+        入力された二値画像を多角形の重ね合わせに分解する
+
+        Args:
+            img_ (np.ndarray): 二値画像 (0 or 255)
+            method (str): "hierarchy"（入れ子の深さを一度のラベリングで求める），"tiled"（タイルに分けて複数プロセスで処理する）
+                または "flood_fill"（深さごとに塗りつぶす従来の方法）．結果は同じ．
+            tile_size (int): method="tiled" のときのタイルの一辺の画素数（外周を追加した画像上）
+            processes (int): method="tiled" のときのプロセス数．None なら CPU 数
+
+        BUG: 幅が 1px の長方形を含むときに正常動作しない → 画像を二倍して処理することにした
+            → 画素の角（格子点）をたどって境界を抽出することにしたので，元の解像度のまま処理する
+        TODO: OpenCV を使って輪郭抽出すれば高速化できそう → 厳密に輪郭を抽出できなかった（角近傍で近似されてしまう）
+        
+        """
+        assert type(img_) == np.ndarray
+        assert img_.dtype == np.uint8
+        assert np.all((img_ == 0) | (img_ == 255))
+        assert len(img_.shape) == 2 # 1 チャンネル画像
+
+        # 外周を追加
+        img = np.pad(img_, 1, constant_values=255)
+
+        # 境界を抽出
+        if method == "hierarchy": geometry = cls._decompose_hierarchy(img)
+        elif method == "tiled": geometry = cls._decompose_tiled(img, tile_size, processes)
+        elif method == "flood_fill": geometry = cls._decompose_flood_fill(img)
+        else: assert False, f"unknown method: {method}"
+
+        return cls._finalize_geometry(geometry)
     
+    @classmethod
+    def _load_native(cls):
+        """
+
+        C++ 版の共有ライブラリ (polygon_decomposer/compile.sh でビルド) を読み込む．存在しなければ None を返す．
+
+        """
+        if cls._native is None:
+            cls._native = False
+            path = CXX_DIR / ("cxx_decompose.dll" if os.name == "nt" else "cxx_decompose.so")
+            if not path.exists(): return None
+            try:
+                lib = ctypes.CDLL(str(path))
+            except OSError:
+                return None
+            lib.cxx_decompose_run.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int]
+            lib.cxx_decompose_run.restype = ctypes.c_void_p
+            lib.cxx_decompose_size.argtypes = [ctypes.c_void_p]
+            lib.cxx_decompose_size.restype = ctypes.c_int64
+            lib.cxx_decompose_data.argtypes = [ctypes.c_void_p]
+            lib.cxx_decompose_data.restype = ctypes.POINTER(ctypes.c_int32)
+            lib.cxx_decompose_free.argtypes = [ctypes.c_void_p]
+            lib.cxx_decompose_free.restype = None
+            cls._native = lib
+        return cls._native or None
+
+    @staticmethod
+    def _deserialize(flat: np.ndarray) -> list:
+        """
+
+        C++ 版が返す int32 の一次元配列を geometry に変換する
+
+        Note:
+            [階層数, (多角形数, (頂点数, i0, j0, i1, j1, ...) x 多角形数) x 階層数]
+
+        """
+        geometry = list()
+        k = 1
+        for _ in range(int(flat[0])):
+            polygons = list()
+            for _ in range(int(flat[k])):
+                n = int(flat[k+1])
+                polygons.append(flat[k+2:k+2+2*n].reshape(n, 2).tolist())
+                k += 1+2*n
+            geometry.append(polygons)
+            k += 1
+        return geometry
+
     @staticmethod
-    def cxx_decompose(img: np.ndarray) -> list:
+    def _encode_image(img: np.ndarray) -> bytes:
+        """ 実行ファイルにパイプで渡す形式 [H (int32), W (int32), 画素 (uint8) x H x W] に変換する """
+        return np.array(img.shape, dtype=np.int32).tobytes() + np.ascontiguousarray(img).tobytes()
+
+    @classmethod
+    def _binary_supported(cls) -> bool:
+        """
+
+        実行ファイルが標準入出力での受け渡し (--binary, --server) に対応しているかを，小さな画像を一度分解して確かめる
+
+        """
+        if cls._binary is None:
+            img = np.zeros((1, 1), dtype=np.uint8)
+            try:
+                proc = subprocess.run(
+                    args=[CXX_EXE_PATH, "--binary"],
+                    input=cls._encode_image(img),
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                    timeout=10,
+                )
+                flat = np.frombuffer(proc.stdout[:len(proc.stdout)//4*4], dtype=np.int32)
+                cls._binary = proc.returncode == 0 and len(flat) > 0 and flat[0] == len(flat)-1 and \
+                    cls._deserialize(flat[1:]) == cls.decompose(img)
+            except (OSError, subprocess.TimeoutExpired, ValueError, IndexError):
+                cls._binary = False
+        return cls._binary
+
+    @classmethod
+    def _native_decompose(cls, lib, img: np.ndarray) -> list:
+        """ 共有ライブラリを呼び出して分解する（画像のバッファをそのまま渡す） """
+        img = np.ascontiguousarray(img)
+        handle = lib.cxx_decompose_run(img.ctypes.data, img.shape[0], img.shape[1])
+        try:
+            size = lib.cxx_decompose_size(handle)
+            flat = np.ctypeslib.as_array(lib.cxx_decompose_data(handle), shape=(size,))
+            return cls._deserialize(flat)
+        finally:
+            lib.cxx_decompose_free(handle)
+
+    @classmethod
+    def cxx_decompose(cls, img: np.ndarray, native: bool = True, protocol: str = "binary") -> list:
         """
         
         C++ 版の decompose
 
+        Args:
+            img (np.ndarray): 二値画像 (0 or 255)
+            native (bool): 共有ライブラリがあればプロセス内で呼び出す．False または共有ライブラリがない場合は実行ファイルを呼び出す．
+            protocol (str): 実行ファイルとの受け渡し形式．"binary"（標準入出力のパイプ）または "text"（一時ファイル）．
+
+        Note:
+            共有ライブラリまたは "binary" を使う場合は子プロセスからも呼び出せる．
+            実行ファイルが "binary" に対応していない（古い実行ファイルの）場合は "text" で受け渡す．
+
         """
         def write_img(img: np.array, path: str) -> None:
             with open(path, 'w') as f:
@@ -232,15 +693,222 @@ class PolygonDecomposer:
             return geometry
 
         assert img.dtype == np.uint8
+        assert len(img.shape) == 2 # 1 チャンネル画像
+        assert np.all((img == 0) | (img == 255))    # C++ 側の assert でプロセスごと落ちないように確認
+
+        lib = cls._load_native() if native else None
+        if lib is not None: return cls._native_decompose(lib, img)
+
+        if protocol == "binary" and not cls._binary_supported(): protocol = "text"
+        if protocol == "binary":
+            proc = subprocess.run(
+                args=[CXX_EXE_PATH, "--binary"],
+                input=cls._encode_image(img),
+                stdout=subprocess.PIPE,
+                check=True,
+            )
+            return cls._deserialize(np.frombuffer(proc.stdout, dtype=np.int32)[1:])
+        assert protocol == "text", f"unknown protocol: {protocol}"
         assert multiprocessing.current_process().name == 'MainProcess'  # 並列処理禁止
 
-        exe_path = Path(__file__).parent / "polygon_decomposer" / "cxx_decompose.exe"
         filename = str(uuid.uuid4())
         write_img(img, path=filename)
-        subprocess.call(args=[exe_path, filename])
+        subprocess.call(args=[CXX_EXE_PATH, filename])
         geometry = read_geometry(filename)
         return geometry
 
+    @classmethod
+    def decompose_many(cls, images, workers: int = None, verbose: bool = False):
+        """
+
+        複数の画像を C++ 版で並列に分解し，入力の順に geometry を返すジェネレータ
+
+        Args:
+            images (iterable[np.ndarray]): 二値画像 (0 or 255) の列
+            workers (int): 並列数．未指定なら CPU 数．
+            verbose (bool): 処理した枚数とスループット [images/s] を表示する
+
+        Note:
+            共有ライブラリがあればスレッドから直接呼び出し（ctypes の呼び出し中は GIL が解放される），
+            なければ常駐させた実行ファイル (DecomposerWorker) に振り分ける．
+            実行ファイルが --server に対応していない場合は，一枚ごとに一時ファイルで受け渡す．
+            先読みする画像は workers*2 枚までなので，images は巨大なジェネレータでもよい．
+
+        """
+        if workers is None: workers = os.cpu_count() or 1
+        lib = cls._load_native()
+        server = lib is None and cls._binary_supported()
+        idle = queue.Queue()
+        if server:
+            for _ in range(workers): idle.put(DecomposerWorker())
+
+        def task(img):
+            if not server: return cls.cxx_decompose(img)
+            worker = idle.get()
+            try:
+                return worker.decompose(img)
+            finally:
+                idle.put(worker)
+
+        begin = time.perf_counter()
+        cnt = 0
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                pending = deque()
+                for img in images:
+                    pending.append(executor.submit(task, img))
+                    if len(pending) < workers*2: continue
+                    yield pending.popleft().result()
+                    cnt += 1
+                    if verbose: print(f"\r{cnt} images  {cnt/(time.perf_counter()-begin):.1f} images/s", end="")
+                while pending:
+                    yield pending.popleft().result()
+                    cnt += 1
+                    if verbose: print(f"\r{cnt} images  {cnt/(time.perf_counter()-begin):.1f} images/s", end="")
+        finally:
+            while not idle.empty(): idle.get().close()
+            if verbose: print()
+
+
+class DecomposerWorker:
+    """
+
+    C++ 版の実行ファイルを常駐させ (--server)，標準入出力のパイプで画像を送って分解する
+
+    Note:
+        一枚ごとにプロセスを起動しないので，小さい画像を大量に分解する場合に速い．
+        スレッドセーフではないので，並列に使う場合はスレッドごとに生成する．
+
+    """
+    def __init__(self):
+        self._proc = subprocess.Popen(
+            args=[CXX_EXE_PATH, "--server"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def decompose(self, img: np.ndarray) -> list:
+        assert img.dtype == np.uint8
+        assert len(img.shape) == 2 # 1 チャンネル画像
+        assert np.all((img == 0) | (img == 255))
+
+        self._proc.stdin.write(PolygonDecomposer._encode_image(img))
+        self._proc.stdin.flush()
+        header = self._proc.stdout.read(4)
+        if len(header) != 4: raise RuntimeError("cxx_decompose worker exited unexpectedly")
+        size = int(np.frombuffer(header, dtype=np.int32)[0])
+        flat = np.frombuffer(self._proc.stdout.read(4*size), dtype=np.int32)
+        if len(flat) != size: raise RuntimeError("cxx_decompose worker exited unexpectedly")
+        return PolygonDecomposer._deserialize(flat)
+
+    def close(self):
+        if self._proc.poll() is None:
+            self._proc.stdin.close()
+            self._proc.wait()
+        self._proc.stdout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class DecompositionCache:
+    """
+
+    画像の形状とバイト列のハッシュをキーとして分解結果をキャッシュする（メモリ上の LRU とディスク）
+
+    Examples:
+        cache = DecompositionCache(maxsize=4096, cache_dir="./decompose_cache")
+        geometry = cache.decompose(img)                 # PolygonDecomposer.decompose をキャッシュ付きで呼び出す
+        print(cache.stats()); cache.reset_stats()       # 世代ごとのヒット数を確認する
+
+    """
+    def __init__(self, maxsize: int = 1024, cache_dir: str = None, decomposer=None):
+        """
+
+        Args:
+            maxsize (int): メモリ上に保持する結果の数
+            cache_dir (str): ディスクに結果を保存するディレクトリ．未指定ならメモリのみ．
+            decomposer (function(img: np.ndarray)): 分解する関数．未指定なら PolygonDecomposer.decompose．
+
+        """
+        assert maxsize >= 0
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.decomposer = PolygonDecomposer.decompose if decomposer is None else decomposer
+        self._memory = OrderedDict()
+        if cache_dir is not None: os.makedirs(cache_dir, exist_ok=True)
+        self.reset_stats()
+
+    @staticmethod
+    def key(img: np.ndarray) -> str:
+        h = hashlib.sha256()
+        h.update(f"{img.dtype.str}{img.shape}".encode())
+        h.update(np.ascontiguousarray(img).tobytes())
+        return h.hexdigest()
+
+    def _disk_path(self, key: str):
+        return os.path.join(self.cache_dir, f"{key}.txt")
+
+    def _put_memory(self, key: str, geometry: list):
+        self._memory[key] = geometry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxsize: self._memory.popitem(last=False)
+
+    def get(self, img: np.ndarray):
+        """ キャッシュから分解結果を取得する．存在しなかったら None を返す． """
+        key = self.key(img)
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(self._memory[key])
+        if self.cache_dir is not None and os.path.exists(self._disk_path(key)):
+            with open(self._disk_path(key)) as f:
+                geometry = str_to_list(f.read())
+            self._put_memory(key, geometry)
+            self.disk_hits += 1
+            return copy.deepcopy(geometry)
+        return None
+
+    def put(self, img: np.ndarray, geometry: list):
+        key = self.key(img)
+        geometry = copy.deepcopy(geometry)
+        self._put_memory(key, geometry)
+        if self.cache_dir is not None:
+            path = self._disk_path(key)
+            tmp = f"{path}.{uuid.uuid4()}"     # 書き込み途中のファイルを読まないように置き換える
+            with open(tmp, 'w') as f:
+                f.write(list_to_str(geometry))
+            os.replace(tmp, path)
+
+    def decompose(self, img: np.ndarray) -> list:
+        """ キャッシュになければ decomposer で分解してキャッシュに追加する """
+        geometry = self.get(img)
+        if geometry is not None: return geometry
+        self.misses += 1
+        geometry = self.decomposer(img)
+        self.put(img, geometry)
+        return geometry
+
+    __call__ = decompose
+
+    def stats(self) -> dict:
+        total = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / total if total else 0.0,
+            "size": len(self._memory),
+        }
+
+    def reset_stats(self):
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
 
 # if __name__ == '__main__':
 #     original = cv2.imread("./polygon_decomposer/sample/small_in.bmp", cv2.IMREAD_GRAYSCALE)
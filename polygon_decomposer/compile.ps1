@@ -2,3 +2,7 @@
 g++ cxx_decompose.cpp `
     -I ./../../cxx_library/source `
     -std=c++17 -o cxx_decompose.exe
+# Python から ctypes で読み込む共有ライブラリ
+g++ cxx_decompose.cpp `
+    -I ./../../cxx_library/source `
+    -std=c++17 -O2 -shared -DCXX_DECOMPOSE_LIB -o cxx_decompose.dll
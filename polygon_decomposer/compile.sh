@@ -0,0 +1,8 @@
+# cxx-library のバージョンは cxx_decompose.cpp の上部を参照
+# 実行ファイル (cxx_decompose) と Python から ctypes で読み込む共有ライブラリ (cxx_decompose.so)
+g++ cxx_decompose.cpp \
+    -I ./../../cxx_library/source \
+    -std=c++17 -O2 -o cxx_decompose
+g++ cxx_decompose.cpp \
+    -I ./../../cxx_library/source \
+    -std=c++17 -O2 -shared -fPIC -DCXX_DECOMPOSE_LIB -o cxx_decompose.so
@@ -5,6 +5,13 @@
 #include <cassert>
 #include <queue>
 #include <execution>
+#include <cstdint>
+#include <cstdio>
+#include <string>
+#ifdef _WIN32
+#include <io.h>
+#include <fcntl.h>
+#endif
 #include "stdout.hpp"
 #include "algorithm.hpp" /* cxx-library: 3059aee6a64d37f5c94308826e85cb7e783cfaa3 */
 
@@ -51,49 +58,38 @@ void flood_fill(Mat &arr, const int begin_y, const int begin_x, const int r_colo
     }
 }
 
-/* 入力された二値画像のうち，指定された座標 (begin) を含む領域の境界を抽出する */
+/* 入力された二値画像のうち，指定された座標 (begin) を含む領域の境界を抽出する
+ * 画素の角（格子点）を結ぶ辺をたどるので，幅が 1px の形状もそのまま扱える
+ * begin は領域のラスタ順で最初の画素とし，その左上の角から領域を右手に見ながら（時計回りに）たどる
+ * 格子点 (i, j) は画素 (i, j) の左上の角 */
 std::vector<int2> extract_boundary(const Mat &img, const int2 begin)
 {
     const int H = img.size();
     const int W = img[0].size();
+    const int color = img[begin.first][begin.second];
+    auto inside = [&](int i, int j)
+    { return 0 <= i and i < H and 0 <= j and j < W and img[i][j] == color; };
 
-    /* 境界を抽出 */
-    std::vector<int2> boundary{begin};
-    int search_cnt = 0;
+    /* 進行方向 d (右，下，左，上) に対して，格子点の左前方と右前方にある画素 */
+    const int LI[4]{-1, 0, 0, -1}, LJ[4]{0, 0, -1, -1};
+    const int RI[4]{0, 0, -1, -1}, RJ[4]{0, -1, -1, 0};
+
+    std::vector<int2> vertices{begin};
+    auto [i, j] = begin;
+    int d = 0;
     while (true)
     {
-        auto [i, j] = boundary.back();
-        for (int k = 0; k < 4; ++k)
-        {
-            int ni = i + DI[(search_cnt + k) % 4];
-            int nj = j + DJ[(search_cnt + k) % 4];
-            if (!(0 <= ni and ni < H))
-                continue;
-            if (!(0 <= nj and nj < W))
-                continue;
-            if (img[ni][nj] != img[begin.first][begin.second])
-                continue;
-            boundary.emplace_back(ni, nj);
-            search_cnt = (search_cnt + k - 1 + 4) % 4; /* % で割られる値が負になると期待通りに動作しない */
+        i += DI[d];
+        j += DJ[d];
+        if (int2{i, j} == begin)
             break;
-        }
-
-        if (boundary.size() > 1 and boundary.front() == boundary.back())
-            break;
-    }
-
-    /* 境界から頂点を抽出する */
-    std::vector<int2> vertices{boundary.front()};
-    for (int k = 1; k < boundary.size() - 1; ++k)
-    {
-        auto [i1, j1] = boundary[k - 1];
-        auto [i2, j2] = boundary[k];
-        auto [i3, j3] = boundary[k + 1];
-        if (i1 == i2 and i2 == i3)
-            continue;
-        if (j1 == j2 and j2 == j3)
+        if (!inside(i + RI[d], j + RJ[d]))
+            d = (d + 1) % 4; /* 右に曲がる */
+        else if (inside(i + LI[d], j + LJ[d]))
+            d = (d + 3) % 4; /* 左に曲がる */
+        else
             continue;
-        vertices.emplace_back(boundary[k]);
+        vertices.emplace_back(i, j);
     }
     return vertices;
 }
@@ -159,13 +155,11 @@ std::vector<std::vector<std::vector<int2>>> decompose(const Mat &img)
         for (const auto i : vec)
             assert(i == OFF or i == ON and "img must be binary");
 
-    /* 画像を二倍に拡大して外周を追加 */
-    Mat enlarged_img(H * 2 + 2, std::vector<int>(W * 2 + 2, ON));
+    /* 外周を追加 */
+    Mat enlarged_img(H + 2, std::vector<int>(W + 2, ON));
     for (int i = 0; i < H; ++i)
         for (int j = 0; j < W; ++j)
-            for (int k = 0; k < 2; ++k)
-                for (int l = 0; l < 2; ++l)
-                    enlarged_img[1 + i * 2 + k][1 + j * 2 + l] = img[i][j];
+            enlarged_img[1 + i][1 + j] = img[i][j];
 
     /* 交互に塗りつぶしながら境界を抽出 */
     std::vector<std::vector<std::vector<int2>>> geometry;
@@ -200,60 +194,81 @@ std::vector<std::vector<std::vector<int2>>> decompose(const Mat &img)
         geometry.emplace_back(extract_boundaries(diff));
     }
 
-    /* x+ および y+ 側の境界は +2 する（ピクセル上では半開区間で表現されているがモデリング時には閉区間で形状を指定するから） */
-    /* +1 じゃなくて +2 なのは元画像を二倍しているから */
     /* 外周を追加した分を差し引く */
-    for (int i = 0; i < geometry.size(); ++i)
+    for (auto &polygons : geometry)
+        for (auto &polygon : polygons)
+            for (auto &[i, j] : polygon)
+                i -= 1, j -= 1;
+
+    return geometry;
+}
+
+/* 画像のバッファ (H x W, uint8) を Mat に変換 */
+Mat to_mat(const uint8_t *data, const int H, const int W)
+{
+    Mat img(H, std::vector<int>(W));
+    for (int i = 0; i < H; ++i)
+        for (int j = 0; j < W; ++j)
+            img[i][j] = data[i * W + j];
+    return img;
+}
+
+/* geometry を int32 の一次元配列に変換
+ * [階層数, (多角形数, (頂点数, i0, j0, i1, j1, ...) x 多角形数) x 階層数] */
+std::vector<int32_t> serialize(const std::vector<std::vector<std::vector<int2>>> &geometry)
+{
+    std::vector<int32_t> ret{int32_t(geometry.size())};
+    for (const auto &polygons : geometry)
     {
-        for (int j = 0; j < geometry[i].size(); ++j)
+        ret.emplace_back(polygons.size());
+        for (const auto &polygon : polygons)
         {
-            std::vector<int2> shift;
-            auto points = geometry[i][j];
-            auto points_front = points.front();
-            auto points_back = points.back();
-            points.emplace(points.begin(), points_back);
-            points.emplace_back(points_front);
-
-            for (int k = 1; k < points.size() - 1; ++k)
+            ret.emplace_back(polygon.size());
+            for (const auto [i, j] : polygon)
             {
-                auto [i1, j1] = points[k - 1];
-                auto [i2, j2] = points[k];
-                auto [i3, j3] = points[k + 1];
-                auto [di1, di2] = int2{i2 - i1, i3 - i2};
-                auto [dj1, dj2] = int2{j2 - j1, j3 - j2};
-
-                assert((di1 == 0 and di2 != 0 and dj1 != 0 and dj2 == 0) or
-                       (di1 != 0 and di2 == 0 and dj1 == 0 and dj2 != 0));
-                int shift_i = (dj1 < 0 or dj2 < 0) ? 2 : 0;
-                int shift_j = (di1 > 0 or di2 > 0) ? 2 : 0;
-                shift.emplace_back(shift_i, shift_j);
-            }
-            assert(shift.size() == geometry[i][j].size());
-
-            for (int k = 0; k < shift.size(); ++k)
-            {
-                geometry[i][j][k].first += shift[k].first - 1;
-                geometry[i][j][k].second += shift[k].second - 1;
+                ret.emplace_back(i);
+                ret.emplace_back(j);
             }
         }
     }
+    return ret;
+}
 
-    /* 二倍した分をもとに戻す */
-    for (int i = 0; i < geometry.size(); ++i)
-        for (int j = 0; j < geometry[i].size(); ++j)
-            for (int k = 0; k < geometry[i][j].size(); ++k)
-                geometry[i][j][k] = {int(geometry[i][j][k].first * 0.5),
-                                     int(geometry[i][j][k].second * 0.5)};
+/* Python (ctypes) から呼び出すための C API */
+#ifdef _WIN32
+#define CXX_DECOMPOSE_API extern "C" __declspec(dllexport)
+#else
+#define CXX_DECOMPOSE_API extern "C" __attribute__((visibility("default")))
+#endif
 
-    return geometry;
+/* 二値画像 (H x W, uint8, C 連続) を分解して結果のハンドルを返す（cxx_decompose_free で解放する） */
+CXX_DECOMPOSE_API void *cxx_decompose_run(const uint8_t *data, const int H, const int W)
+{
+    return new std::vector<int32_t>(serialize(decompose(to_mat(data, H, W))));
 }
 
-int main(int argc, char *argv[])
+CXX_DECOMPOSE_API int64_t cxx_decompose_size(const void *handle)
 {
-    assert(argc == 2);
+    return static_cast<const std::vector<int32_t> *>(handle)->size();
+}
+
+CXX_DECOMPOSE_API const int32_t *cxx_decompose_data(const void *handle)
+{
+    return static_cast<const std::vector<int32_t> *>(handle)->data();
+}
+
+CXX_DECOMPOSE_API void cxx_decompose_free(void *handle)
+{
+    delete static_cast<std::vector<int32_t> *>(handle);
+}
 
+/* 共有ライブラリとしてビルドするときは main を含めない */
+#ifndef CXX_DECOMPOSE_LIB
+/* テキスト形式: ファイルから画像を読み込み，同じファイルに geometry を書き出す */
+int run_text(const char *path)
+{
     /* 入力読み込み */
-    std::ifstream ifs(argv[1]);
+    std::ifstream ifs(path);
     assert(ifs);
     int H, W;
     ifs >> H >> W;
@@ -266,7 +281,7 @@ int main(int argc, char *argv[])
     auto geometry = decompose(img);
 
     /* 結果を出力 */
-    std::ofstream ofs(argv[1]);
+    std::ofstream ofs(path);
     assert(ofs);
     ofs << geometry.size() << endl;
     for (auto g : geometry)
@@ -282,3 +297,47 @@ int main(int argc, char *argv[])
 
     return 0;
 }
+
+/* バイナリ形式: 標準入力から [H (int32), W (int32), 画素 (uint8) x H x W] を読み込み，
+ * 標準出力に [要素数 N (int32), serialize した geometry (int32) x N] を書き出す．
+ * 入力が終端に達していたら false を返す */
+bool run_binary()
+{
+    int32_t shape[2];
+    if (std::fread(shape, sizeof(int32_t), 2, stdin) != 2)
+        return false;
+    const auto [H, W] = std::pair{shape[0], shape[1]};
+    std::vector<uint8_t> data(size_t(H) * W);
+    if (std::fread(data.data(), 1, data.size(), stdin) != data.size())
+        return false;
+
+    auto flat = serialize(decompose(to_mat(data.data(), H, W)));
+    const int32_t size = flat.size();
+    std::fwrite(&size, sizeof(int32_t), 1, stdout);
+    std::fwrite(flat.data(), sizeof(int32_t), flat.size(), stdout);
+    std::fflush(stdout);
+    return true;
+}
+
+/* --binary: バイナリ形式で一枚だけ分解する
+ * --server: 標準入力が閉じられるまでバイナリ形式の画像を順に分解し続ける（常駐ワーカー）
+ * それ以外: テキスト形式のファイルのパス */
+int main(int argc, char *argv[])
+{
+    assert(argc == 2);
+    const std::string mode(argv[1]);
+    if (mode == "--binary" or mode == "--server")
+    {
+#ifdef _WIN32
+        _setmode(_fileno(stdin), _O_BINARY);
+        _setmode(_fileno(stdout), _O_BINARY);
+#endif
+        if (mode == "--binary")
+            return run_binary() ? 0 : 1;
+        while (run_binary())
+            ;
+        return 0;
+    }
+    return run_text(argv[1]);
+}
+#endif